@@ -0,0 +1,186 @@
+"""Servidor HTTP local que imita el servicio SW-PML del CENACE para pruebas de rendimiento.
+
+Atiende las mismas rutas que consulta CenacePMLFetcher:
+    /SWPML/SIM/<sistema>/<proceso>/<nodo-nodo-...>/<aaaa>/<mm>/<dd>/<aaaa>/<mm>/<dd>/<JSON|XML>
+y responde un 'Reporte' sintético con 24 valores por nodo y día. La latencia y la tasa de
+errores 503 son configurables; con la misma semilla se generan los mismos precios.
+
+Uso independiente:
+    python cenace_stub.py --puerto 8099 --latencia-ms 200 --tasa-error 0.05
+    (luego CenacePMLFetcher(base_url="http://127.0.0.1:8099/SWPML/SIM/"))
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def claves_de_ruta(segmento):
+    # Las claves de nodo tienen la forma 01ABC-115 y la URL las une con '-': se reagrupan por pares
+    partes = segmento.split("-")
+    return ["-".join(partes[i:i + 2]) for i in range(0, len(partes), 2)]
+
+
+def valores_nodo(clave, dias, semilla):
+    """Precios sintéticos por hora (1-24) para un nodo: base por nodo + forma diaria + ruido."""
+    rng = np.random.default_rng([semilla, zlib.crc32(clave.encode("utf-8"))])
+    horas = np.tile(np.arange(1, 25), len(dias))
+    forma_diaria = 400 + 250 * np.sin((horas - 7) / 24 * 2 * np.pi)
+    pml = forma_diaria + rng.normal(0, 60, len(horas))
+    pml_per = rng.uniform(1, 30, len(horas))
+    pml_cng = rng.normal(0, 15, len(horas))
+    pml_ene = pml - pml_per - pml_cng
+    fechas = np.repeat([d.isoformat() for d in dias], 24)
+    return [
+        {"fecha": f, "hora": str(h), "pml": f"{p:.2f}", "pml_ene": f"{e:.2f}", "pml_per": f"{pe:.2f}", "pml_cng": f"{c:.2f}"}
+        for f, h, p, e, pe, c in zip(fechas, horas, pml, pml_ene, pml_per, pml_cng)
+    ]
+
+
+@lru_cache(maxsize=2048)
+def generar_reporte(ruta, semilla):
+    """Cuerpo y tipo de contenido para una ruta; se guarda en memoria para no medir la generación."""
+    partes = ruta.strip("/").split("/")
+    # SWPML/SIM/<sistema>/<proceso>/<nodos>/<aaaa>/<mm>/<dd>/<aaaa>/<mm>/<dd>/<formato>
+    claves = claves_de_ruta(partes[4])
+    inicio = date(int(partes[5]), int(partes[6]), int(partes[7]))
+    fin = date(int(partes[8]), int(partes[9]), int(partes[10]))
+    formato = partes[11].upper()
+    dias = [inicio + timedelta(days=i) for i in range((fin - inicio).days + 1)]
+
+    resultados = [{"clv_nodo": clave, "Valores": valores_nodo(clave, dias, semilla)} for clave in claves]
+    if formato == "XML":
+        nodos_xml = []
+        for resultado in resultados:
+            valores_xml = "".join(
+                "<Valor>" + "".join(f"<{campo}>{valor}</{campo}>" for campo, valor in v.items()) + "</Valor>"
+                for v in resultado["Valores"]
+            )
+            nodos_xml.append(f"<Nodo><clv_nodo>{resultado['clv_nodo']}</clv_nodo><Valores>{valores_xml}</Valores></Nodo>")
+        cuerpo = f"<Reporte><nombre>PML</nombre><Resultados>{''.join(nodos_xml)}</Resultados></Reporte>"
+        return cuerpo.encode("utf-8"), "application/xml"
+    cuerpo = json.dumps({"Reporte": {"nombre": "PML", "Resultados": resultados}})
+    return cuerpo.encode("utf-8"), "application/json"
+
+
+class CenaceStub:
+    """Servidor en un hilo de fondo. Se puede usar como administrador de contexto.
+
+    latencia_ms y jitter_ms se aplican antes de cada respuesta; tasa_error es la probabilidad
+    de responder 503 (error transitorio que el fetcher reintenta).
+    """
+
+    def __init__(self, latencia_ms=0, jitter_ms=0, tasa_error=0.0, semilla=0, host="127.0.0.1", puerto=0):
+        self.latencia_ms = latencia_ms
+        self.jitter_ms = jitter_ms
+        self.tasa_error = tasa_error
+        self.semilla = semilla
+        self.solicitudes = 0
+        self.errores = 0
+        self.bytes_enviados = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(semilla)
+        self._server = ThreadingHTTPServer((host, puerto), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, puerto = self._server.server_address[:2]
+        return f"http://{host}:{puerto}/SWPML/SIM/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.solicitudes = 0
+            self.errores = 0
+            self.bytes_enviados = 0
+
+    def _responder(self, handler):
+        with self._lock:
+            self.solicitudes += 1
+            espera = self.latencia_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+            falla = self._rng.random() < self.tasa_error
+            if falla:
+                self.errores += 1
+        if espera > 0:
+            time.sleep(espera / 1000)
+
+        if falla:
+            handler.send_response(503)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        try:
+            cuerpo, tipo = generar_reporte(handler.path, self.semilla)
+        except (IndexError, ValueError):
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", tipo)
+        handler.send_header("Content-Length", str(len(cuerpo)))
+        handler.end_headers()
+        handler.wfile.write(cuerpo)
+        with self._lock:
+            self.bytes_enviados += len(cuerpo)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Conexiones persistentes, como el pool del fetcher
+
+            def do_GET(self):
+                stub._responder(self)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor local que imita el servicio SW-PML del CENACE.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8099)
+    parser.add_argument("--latencia-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Probabilidad de responder 503 (0 a 1)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    stub = CenaceStub(args.latencia_ms, args.jitter_ms, args.tasa_error, args.semilla, args.host, args.puerto)
+    print(f"Sirviendo en {stub.base_url} (Ctrl+C para terminar)")
+    stub.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
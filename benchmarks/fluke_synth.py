@@ -0,0 +1,78 @@
+"""Genera archivos CSV sintéticos con el formato de exportación de los analizadores Fluke.
+
+La columna Timestamp usa el formato "%m/%d/%Y %I:%M:%S %p" de las exportaciones reales y el
+resto son canales numéricos (tensiones, corrientes, potencias, frecuencia y THD).
+
+Uso:
+    python fluke_synth.py --filas 1000000 --intervalo 1s --salida fluke_1M.csv
+"""
+import argparse
+import io
+
+import numpy as np
+import pandas as pd
+
+CANALES_FLUKE = [
+    "V1 rms (V)", "V2 rms (V)", "V3 rms (V)",
+    "A1 rms (A)", "A2 rms (A)", "A3 rms (A)",
+    "P total (W)", "Q total (var)", "PF total",
+    "Frequency (Hz)", "THD V1 (%)", "THD A1 (%)",
+]
+
+FORMATO_TIMESTAMP_FLUKE = "%m/%d/%Y %I:%M:%S %p"
+
+FILAS_POR_BLOQUE = 200_000
+
+
+def bloque_fluke(inicio, filas, intervalo, rng, desfase):
+    timestamps = pd.date_range(inicio, periods=filas, freq=intervalo)
+    t = np.arange(desfase, desfase + filas, dtype="float64")
+    # Ciclo de carga diario más ruido: suficiente para que LTTB y los rollups tengan forma que conservar
+    ciclo = np.sin(t * pd.Timedelta(intervalo).total_seconds() / 86400 * 2 * np.pi)
+    datos = {"Timestamp": timestamps.strftime(FORMATO_TIMESTAMP_FLUKE)}
+    for i in range(3):
+        datos[CANALES_FLUKE[i]] = 127 + 2 * ciclo + rng.normal(0, 0.5, filas)
+    for i in range(3, 6):
+        datos[CANALES_FLUKE[i]] = 80 + 40 * ciclo + rng.normal(0, 3, filas)
+    datos["P total (W)"] = 30000 + 15000 * ciclo + rng.normal(0, 800, filas)
+    datos["Q total (var)"] = 6000 + 2000 * ciclo + rng.normal(0, 300, filas)
+    datos["PF total"] = np.clip(0.95 + rng.normal(0, 0.01, filas), 0, 1)
+    datos["Frequency (Hz)"] = 60 + rng.normal(0, 0.02, filas)
+    datos["THD V1 (%)"] = np.abs(2.5 + rng.normal(0, 0.3, filas))
+    datos["THD A1 (%)"] = np.abs(8 + 3 * ciclo + rng.normal(0, 1, filas))
+    return pd.DataFrame(datos)
+
+
+def write_fluke_csv(destino, filas, intervalo="1s", inicio="2025-01-01", semilla=0):
+    """Escribe el CSV por bloques en destino (ruta o archivo binario abierto)."""
+    rng = np.random.default_rng(semilla)
+    inicio = pd.Timestamp(inicio)
+    paso = pd.Timedelta(intervalo)
+    primero = True
+    for desfase in range(0, filas, FILAS_POR_BLOQUE):
+        n = min(FILAS_POR_BLOQUE, filas - desfase)
+        bloque = bloque_fluke(inicio + paso * desfase, n, intervalo, rng, desfase)
+        bloque.to_csv(destino, index=False, header=primero, mode="w" if primero else "a", float_format="%.3f")
+        primero = False
+
+
+def fluke_csv_bytes(filas, intervalo="1s", inicio="2025-01-01", semilla=0):
+    """Contenido del CSV en memoria, como lo entrega st.file_uploader."""
+    buffer = io.StringIO()
+    write_fluke_csv(buffer, filas, intervalo, inicio, semilla)
+    return buffer.getvalue().encode("utf-8")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera un CSV sintético de analizador Fluke.")
+    parser.add_argument("--filas", type=int, default=1_000_000)
+    parser.add_argument("--intervalo", default="1s", help="Intervalo de muestreo (p. ej. 200ms, 1s, 1min)")
+    parser.add_argument("--inicio", default="2025-01-01")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", required=True)
+    args = parser.parse_args(argv)
+    write_fluke_csv(args.salida, args.filas, args.intervalo, args.inicio, args.semilla)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""Pruebas de rendimiento de la descarga, procesamiento y graficado de PML y de archivos Fluke.
+
+Todo corre contra datos sintéticos: las consultas van a un servidor local (cenace_stub.py) que
+imita al CENACE, y los archivos Fluke salen de fluke_synth.py. Por cada etapa se reporta el
+tiempo (mediana de las repeticiones), filas por segundo, MB por segundo, percentiles de latencia
+por consulta y memoria pico.
+
+Ejemplos:
+    python run_benchmarks.py
+    python run_benchmarks.py --nodos 400 --dias 28 --latencia-ms 150 --tasa-error 0.02
+    python run_benchmarks.py --json base.json                          # guardar una referencia
+    python run_benchmarks.py --base base.json --tolerancia 0.25        # falla si una etapa empeora
+
+La memoria pico se mide con tracemalloc en una corrida aparte (no cronometrada): incluye los
+arreglos de NumPy/pandas pero no los búferes internos de pyarrow.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "cenacepml"))
+sys.path.insert(0, REPO_DIR)
+
+from cenace_stub import CenaceStub  # noqa: E402
+from fluke_analysis import (  # noqa: E402
+    build_rollup_pyramid,
+    downsample_series,
+    power_quality_stats,
+    read_fluke_csv,
+    time_range_slice,
+)
+from fluke_store import FlukeRecording, ingest_csvs  # noqa: E402
+from fluke_synth import fluke_csv_bytes  # noqa: E402
+from pml_core import (  # noqa: E402
+    FORMATOS_EXPORTACION,
+    CenacePMLFetcher,
+    NodosIndex,
+    PMLAggregator,
+    PMLStore,
+    export_frame,
+)
+
+
+class FetcherMedido(CenacePMLFetcher):
+    """CenacePMLFetcher que guarda la duración de cada consulta (incluidos los reintentos)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencias = []
+
+    def request_pml_data(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return super().request_pml_data(*args, **kwargs)
+        finally:
+            self.latencias.append(time.perf_counter() - inicio)
+
+
+def catalogo_sintetico(num_nodos, sistema="SIN"):
+    """Catálogo con la forma de read_nodos_catalogo: 32 estados y 10 municipios por estado."""
+    i = np.arange(num_nodos)
+    return pd.DataFrame({
+        "CLAVE_NODO_P": [f"{n % 32 + 1:02d}B{n:04d}-115" for n in i],
+        "ESTADO": [f"ESTADO {n % 32 + 1:02d}" for n in i],
+        "MUNICIPIO": [f"MUNICIPIO {n % 320:03d}" for n in i],
+        "SISTEMA": sistema,
+    })
+
+
+def percentil_ms(valores, q):
+    return float(np.percentile(valores, q) * 1000) if valores else None
+
+
+class Benchmark:
+    def __init__(self, repeticiones, medir_memoria=True):
+        self.repeticiones = repeticiones
+        self.medir_memoria = medir_memoria
+        self.resultados = []
+
+    def etapa(self, nombre, funcion, filas=None, bytes_procesados=None, latencias=None):
+        """Corre funcion() repeticiones veces (más una con tracemalloc) y guarda sus métricas.
+
+        filas, bytes_procesados y latencias pueden ser funciones que reciben el resultado de la
+        última repetición y se evalúan al final, cuando la etapa ya produjo esos datos.
+        """
+        tiempos = []
+        resultado = None
+        for _ in range(self.repeticiones):
+            inicio = time.perf_counter()
+            resultado = funcion()
+            tiempos.append(time.perf_counter() - inicio)
+
+        memoria_pico_mb = None
+        if self.medir_memoria:
+            tracemalloc.start()
+            try:
+                funcion()
+                memoria_pico_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            finally:
+                tracemalloc.stop()
+
+        segundos = statistics.median(tiempos)
+        filas = filas(resultado) if callable(filas) else filas
+        bytes_procesados = bytes_procesados(resultado) if callable(bytes_procesados) else bytes_procesados
+        latencias = latencias(resultado) if callable(latencias) else latencias
+        self.resultados.append({
+            "etapa": nombre,
+            "segundos": segundos,
+            "filas": filas,
+            "filas_por_s": filas / segundos if filas and segundos else None,
+            "mb_por_s": bytes_procesados / 2**20 / segundos if bytes_procesados and segundos else None,
+            "latencia_p50_ms": percentil_ms(latencias, 50),
+            "latencia_p90_ms": percentil_ms(latencias, 90),
+            "latencia_p99_ms": percentil_ms(latencias, 99),
+            "memoria_pico_mb": memoria_pico_mb,
+        })
+        print(f"  {nombre}: {segundos:.3f} s", file=sys.stderr)
+        return resultado
+
+
+def benchmark_pml(bench, args):
+    catalogo = catalogo_sintetico(args.nodos)
+    nodos_index = NodosIndex(catalogo)
+    nodos = nodos_index.todos_los_nodos
+    fecha_fin = pd.Timestamp(args.fecha_inicio) + pd.Timedelta(days=args.dias - 1)
+    fecha_inicio_str, fecha_fin_str = args.fecha_inicio, fecha_fin.strftime("%Y-%m-%d")
+
+    with CenaceStub(args.latencia_ms, args.jitter_ms, args.tasa_error, args.semilla) as stub:
+        def nuevo_fetcher():
+            return FetcherMedido(base_url=stub.base_url, max_workers=args.max_workers, max_retries=args.reintentos)
+
+        consultas = nuevo_fetcher().plan_requests(nodos, fecha_inicio_str, fecha_fin_str)
+        print(f"PML: {len(nodos)} nodos x {args.dias} días = {len(consultas)} consultas", file=sys.stderr)
+
+        # Calentamiento: el servidor guarda las respuestas generadas, así no se mide su generación
+        for formato in ("JSON", "XML"):
+            list(nuevo_fetcher().fetch_pml_data_concurrent("SIN", "MDA", consultas, formato=formato))
+
+        for formato in ("JSON", "XML"):
+            medicion = {"latencias": [], "bytes": 0, "fallidas": 0}
+
+            def descargar():
+                fetcher = nuevo_fetcher()
+                stub.reset_counters()
+                crudos = [raw for _, raw in fetcher.fetch_pml_data_concurrent("SIN", "MDA", consultas, formato=formato)]
+                medicion["latencias"].extend(fetcher.latencias)
+                medicion["bytes"] = stub.bytes_enviados
+                medicion["fallidas"] = len(fetcher.failed_requests)
+                return crudos
+
+            # El XML se procesa mientras se descarga, así que esta etapa ya incluye el parseo
+            nombre = "pml_descarga_json" if formato == "JSON" else "pml_descarga_y_parseo_xml"
+            crudos = bench.etapa(
+                nombre, descargar,
+                filas=lambda crudos: sum(len(c) for c in crudos if isinstance(c, pd.DataFrame)) or None,
+                bytes_procesados=lambda _: medicion["bytes"],
+                latencias=lambda _: medicion["latencias"],
+            )
+            if medicion["fallidas"]:
+                print(f"  {medicion['fallidas']} consulta(s) {formato} fallaron después de los reintentos",
+                      file=sys.stderr)
+            if formato == "JSON":
+                crudos_json = crudos
+
+    fetcher = CenacePMLFetcher()
+    frames = bench.etapa(
+        "pml_parseo_json",
+        lambda: [fetcher.process_response(raw) for raw in crudos_json],
+        filas=lambda frames: sum(len(f) for f in frames),
+    )
+    filas_totales = sum(len(f) for f in frames)
+
+    def transformar():
+        aggregator = PMLAggregator(["ESTADO"])
+        for frame in frames:
+            aggregator.update(nodos_index.compact_frame(frame))
+        return aggregator.promedio_por_hora(), aggregator.resumen_por_estado()
+
+    bench.etapa("pml_transformacion", transformar, filas=filas_totales)
+
+    compactos = pd.concat([nodos_index.compact_frame(f) for f in frames], ignore_index=True)
+    with tempfile.TemporaryDirectory() as directorio:
+        def almacen():
+            store = PMLStore(os.path.join(directorio, f"pml_{time.perf_counter_ns()}.sqlite"))
+            for frame in frames:
+                store.save("SIN", "MDA", frame)
+            return store.load("SIN", "MDA", nodos, fecha_inicio_str, fecha_fin_str)
+
+        bench.etapa("pml_almacen_guardar_y_leer", almacen, filas=filas_totales)
+
+    for formato in FORMATOS_EXPORTACION:
+        extension = FORMATOS_EXPORTACION[formato][0].lstrip(".").replace(".", "_")
+        bench.etapa(f"pml_exportacion_{extension}", lambda: export_frame(compactos, formato), filas=len(compactos),
+                    bytes_procesados=len)
+
+
+def benchmark_fluke(bench, args):
+    print(f"Fluke: generando {args.fluke_filas:,} filas cada {args.fluke_intervalo}", file=sys.stderr)
+    contenido = fluke_csv_bytes(args.fluke_filas, args.fluke_intervalo, semilla=args.semilla)
+
+    # Las funciones sin el caché de Streamlit: cada repetición hace el trabajo completo
+    df = bench.etapa("fluke_carga_csv", lambda: read_fluke_csv(contenido),
+                     filas=args.fluke_filas, bytes_procesados=len(contenido))
+    bench.etapa("fluke_rollups", lambda: build_rollup_pyramid(df), filas=len(df))
+    canal = df.columns[0]
+    bench.etapa("fluke_lttb", lambda: downsample_series(df[canal]), filas=len(df))
+
+    # Rango de una décima parte del archivo, como al acercarse en la gráfica
+    inicio, fin = df.index[len(df) // 2], df.index[len(df) // 2 + len(df) // 10]
+
+    def rango():
+        serie = df[canal].iloc[time_range_slice(df.index, inicio, fin)]
+        return downsample_series(serie)
+
+    bench.etapa("fluke_rango_y_lttb", rango, filas=len(df) // 10)
+    bench.etapa("fluke_estadisticas",
+                lambda: power_quality_stats(df, "15min", {canal: (None, float(df[canal].median()))}),
+                filas=len(df) * len(df.columns))
+
+    # Almacén fuera de memoria: ingesta por bloques a Parquet y lectura de un canal en el mismo rango
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_csv = os.path.join(directorio, "fluke.csv")
+        with open(ruta_csv, "wb") as f:
+            f.write(contenido)
+
+        def ingesta():
+            # Cada repetición en una grabación nueva: los archivos ya importados se omiten
+            destino = os.path.join(directorio, f"grabacion_{time.perf_counter_ns()}")
+            ingest_csvs([ruta_csv], destino)
+            return destino
+
+        destino = bench.etapa("fluke_almacen_ingesta", ingesta, filas=args.fluke_filas,
+                              bytes_procesados=len(contenido))
+        grabacion = FlukeRecording(destino)
+        bench.etapa("fluke_almacen_rango_y_lttb",
+                    lambda: downsample_series(grabacion.read_channel(canal, inicio, fin)),
+                    filas=len(df) // 10)
+
+
+def comparar(resultados, base, tolerancia):
+    """Regresa las etapas que empeoraron más que la tolerancia en tiempo o en memoria."""
+    base_por_etapa = {r["etapa"]: r for r in base["resultados"]}
+    regresiones = []
+    for r in resultados:
+        anterior = base_por_etapa.get(r["etapa"])
+        if anterior is None:
+            continue
+        for metrica in ("segundos", "memoria_pico_mb"):
+            actual, referencia = r.get(metrica), anterior.get(metrica)
+            if actual is not None and referencia and actual > referencia * (1 + tolerancia):
+                regresiones.append((r["etapa"], metrica, referencia, actual))
+    return regresiones
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Pruebas de rendimiento con datos sintéticos.")
+    parser.add_argument("--solo", choices=["pml", "fluke"], help="Correr solo un grupo de etapas")
+    parser.add_argument("--nodos", type=int, default=100, help="Nodos en el catálogo sintético")
+    parser.add_argument("--dias", type=int, default=14, help="Días consultados por nodo")
+    parser.add_argument("--fecha-inicio", default="2025-01-01")
+    parser.add_argument("--latencia-ms", type=float, default=50, help="Latencia del servidor local por consulta")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Probabilidad de 503 por consulta (0 a 1)")
+    parser.add_argument("--max-workers", type=int, default=8, help="Consultas simultáneas")
+    parser.add_argument("--reintentos", type=int, default=4)
+    parser.add_argument("--fluke-filas", type=int, default=1_000_000)
+    parser.add_argument("--fluke-intervalo", default="1s")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--sin-memoria", action="store_true", help="No hacer la corrida con tracemalloc")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--json", help="Guardar los resultados en este archivo")
+    parser.add_argument("--base", help="Resultados de referencia (de --json) para detectar regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Empeoramiento permitido contra --base (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bench = Benchmark(args.repeticiones, medir_memoria=not args.sin_memoria)
+    if args.solo in (None, "pml"):
+        benchmark_pml(bench, args)
+    if args.solo in (None, "fluke"):
+        benchmark_fluke(bench, args)
+
+    tabla = pd.DataFrame(bench.resultados).set_index("etapa").astype("float64")
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:,.2f}".format):
+        print(tabla.to_string(na_rep="-"))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "parametros": vars(args),
+                "entorno": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                            "plataforma": platform.platform()},
+                "resultados": bench.resultados,
+            }, f, indent=2, ensure_ascii=False)
+
+    if args.base:
+        with open(args.base, encoding="utf-8") as f:
+            regresiones = comparar(bench.resultados, json.load(f), args.tolerancia)
+        for etapa, metrica, referencia, actual in regresiones:
+            print(f"REGRESIÓN {etapa}: {metrica} {referencia:.3f} -> {actual:.3f}", file=sys.stderr)
+        if regresiones:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
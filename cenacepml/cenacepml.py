@@ -1,15 +1,35 @@
 import streamlit as st
-import requests
 import pandas as pd
 import altair as alt
-from datetime import datetime, timedelta
-import warnings
-import json
-import xml.etree.ElementTree as ET
+from datetime import datetime
+import time
+from functools import partial
 import os
 
-# Suprimir advertencias de SSL (solo para desarrollo, no recomendado en producción)
-warnings.filterwarnings('ignore', message='Unverified HTTPS request')
+from pml_core import (
+    CATALOGO_EXTENSIONES,
+    FORMATOS_EXPORTACION,
+    MAX_CONSULTAS_SIMULTANEAS,
+    PML_STORE_PATH,
+    CenacePMLFetcher,
+    CenaceScheduler,
+    NodosIndex,
+    PMLAggregator,
+    PMLStore,
+    VistasCache,
+    configurar_bitacora,
+    downsample_min_max,
+    export_frame,
+    fecha_hora_original,
+    medir,
+    read_nodos_catalogo,
+)
+
+# Una línea JSON por consulta en la bitácora 'cenacepml' (nivel con PML_LOG_LEVEL)
+configurar_bitacora()
+
+# Segundos mínimos entre redibujos de la vista previa mientras llegan las consultas
+INTERVALO_VISTA_PREVIA = 2.0
 
 # --- Constante para la ruta del logotipo ---
 # Obtener el directorio actual del script
@@ -31,202 +51,32 @@ for fname in SOLUMEX_LOGO_POSSIBLE_FILENAMES:
         SOLUMEX_LOGO_PATH_FOUND = full_path
         break
 
-# --- Funciones para obtener y procesar datos ---
-class CenacePMLFetcher:
-    def __init__(self, base_url="https://ws01.cenace.gob.mx:8082/SWPML/SIM/"):
-        self.base_url = base_url
+# --- Cargar el catálogo de nodos (ahora acepta objetos de archivo o rutas de string) ---
+# cache_resource regresa el mismo índice en cada rerun, sin copiarlo; el índice no se modifica
+@st.cache_resource
+def load_nodos_catalogo(file_source):
+    if not isinstance(file_source, str) and os.path.splitext(file_source.name)[1].lower() not in CATALOGO_EXTENSIONES:
+        st.error("Formato de archivo subido no soportado. Por favor, sube un archivo CSV o XLSX.")
+        return NodosIndex(pd.DataFrame())
+    return NodosIndex(read_nodos_catalogo(file_source))
 
-    def fetch_pml_data(self, sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato="JSON"):
-        try:
-            start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d")
-            end_date = datetime.strptime(fecha_fin, "%Y-%m-%d")
-        except ValueError:
-            return None
-
-        anio_ini = start_date.year
-        mes_ini = f"{start_date.month:02d}"
-        dia_ini = f"{start_date.day:02d}"
-        anio_fin = end_date.year
-        mes_fin = f"{end_date.month:02d}"
-        dia_fin = f"{end_date.day:02d}"
-
-        nodos_url_param = "-".join(lista_nodos)
-
-        url = (
-            f"{self.base_url}{sistema}/{proceso}/{nodos_url_param}/"
-            f"{anio_ini}/{mes_ini}/{dia_ini}/"
-            f"{anio_fin}/{mes_fin}/{dia_fin}/{formato}"
-        )
 
-        try:
-            response = requests.get(url, verify=False)
-            response.raise_for_status()
-
-            if formato.upper() == "JSON":
-                return response.json()
-            elif formato.upper() == "XML":
-                return ET.fromstring(response.content)
-            else:
-                return None
-
-        except requests.exceptions.HTTPError:
-            return None
-        except requests.exceptions.ConnectionError:
-            return None
-        except requests.exceptions.Timeout:
-            return None
-        except requests.exceptions.RequestException:
-            return None
-        except json.JSONDecodeError:
-            return None
-        except ET.ParseError:
-            return None
-        except Exception:
-            return None
-
-    def process_json_response(self, json_data):
-        results = []
-        reports_to_process = []
-
-        if isinstance(json_data, dict):
-            if "Reporte" in json_data:
-                if isinstance(json_data["Reporte"], list):
-                    reports_to_process = json_data["Reporte"]
-                else:
-                    reports_to_process = [json_data["Reporte"]]
-            elif "nombre" in json_data and "Resultados" in json_data:
-                reports_to_process = [json_data]
-            else:
-                return results
-        elif isinstance(json_data, list):
-            reports_to_process = json_data
-        else:
-            return results
+# --- Almacén local compartido por todas las sesiones ---
+@st.cache_resource
+def get_pml_store():
+    return PMLStore(PML_STORE_PATH)
 
-        for report_item in reports_to_process:
-            if not isinstance(report_item, dict):
-                continue
 
-            try:
-                resultados_content = report_item.get("Resultados")
-                all_nodes_from_report = []
-
-                if isinstance(resultados_content, dict):
-                    node_data_from_dict = resultados_content.get("Nodo")
-                    if isinstance(node_data_from_dict, list):
-                        all_nodes_from_report.extend(node_data_from_dict)
-                    elif isinstance(node_data_from_dict, dict):
-                        all_nodes_from_report.append(node_data_from_dict)
-                elif isinstance(resultados_content, list):
-                    all_nodes_from_report.extend(resultados_content)
-                else:
-                    continue
-
-                for nodo_data in all_nodes_from_report:
-                    if not isinstance(nodo_data, dict):
-                        continue
-
-                    clv_nodo = nodo_data.get("clv_nodo")
-                    if clv_nodo:
-                        valores_data = nodo_data.get("Valores")
-
-                        if isinstance(valores_data, list):
-                            for valor_item in valores_data:
-                                if not isinstance(valor_item, dict):
-                                    continue
-                                try:
-                                    data = {
-                                        "clv_nodo": clv_nodo,
-                                        "fecha": valor_item.get("fecha"),
-                                        "hora": int(valor_item.get("hora")),
-                                        "pml": float(valor_item.get("pml")),
-                                        "pml_ene": float(valor_item.get("pml_ene")),
-                                        "pml_per": float(valor_item.get("pml_per")),
-                                        "pml_cng": float(valor_item.get("pml_cng"))
-                                    }
-                                    if all(v is not None for v in data.values()):
-                                        results.append(data)
-                                except (ValueError, TypeError):
-                                    pass
-                        else:
-                            pass
-                    else:
-                        pass
-            except Exception:
-                pass
-        return results
-
-
-    def process_xml_response(self, xml_root):
-        results = []
-        if xml_root is not None and xml_root.tag == "Reporte":
-            for nodo_element in xml_root.findall(".//Nodo"):
-                clv_nodo = nodo_element.find("clv_nodo").text if nodo_element.find("clv_nodo") is not None else None
-                if clv_nodo:
-                    for valor_element in nodo_element.findall(".//Valor"):
-                        try:
-                            data = {
-                                "clv_nodo": clv_nodo,
-                                "fecha": valor_element.find("fecha").text if valor_element.find("fecha") is not None else None,
-                                "hora": int(valor_element.find("hora").text) if valor_element.find("hora") is not None else None,
-                                "pml": float(valor_element.find("pml").text) if valor_element.find("pml") is not None else None,
-                                "pml_ene": float(valor_element.find("pml_ene").text) if valor_element.find("pml_ene") is not None else None,
-                                "pml_per": float(valor_element.find("pml_per").text) if valor_element.find("pml_per") is not None else None,
-                                "pml_cng": float(valor_element.find("pml_cng").text) if valor_element.find("pml_cng") is not None else None
-                            }
-                            if all(v is not None for v in data.values()):
-                                results.append(data)
-                        except (ValueError, TypeError):
-                            pass
-        return results
+# --- Planificador compartido: deduplica consultas entre sesiones y limita la carga al CENACE ---
+@st.cache_resource
+def get_cenace_scheduler():
+    return CenaceScheduler()
 
-# --- Cargar el catálogo de nodos (ahora acepta objetos de archivo o rutas de string) ---
-@st.cache_data
-def load_nodos_catalogo(file_source):
-    try:
-        df = pd.DataFrame()
-        file_extension = None
-
-        if isinstance(file_source, str): # Si es una ruta de archivo (string)
-            file_extension = os.path.splitext(file_source)[1].lower()
-            if file_extension == '.csv':
-                df = pd.read_csv(file_source)
-            elif file_extension == '.xlsx':
-                df = pd.read_excel(file_source)
-            else:
-                return pd.DataFrame()
-        else: # Si es un objeto de archivo de Streamlit (UploadedFile)
-            file_extension = os.path.splitext(file_source.name)[1].lower()
-            if file_extension == '.csv':
-                df = pd.read_csv(file_source)
-            elif file_extension == '.xlsx':
-                df = pd.read_excel(file_source)
-            else:
-                st.error("Formato de archivo subido no soportado. Por favor, sube un archivo CSV o XLSX.")
-                return pd.DataFrame()
-
-        original_columns = df.columns.tolist()
-        cleaned_columns = [col.strip().replace(' ', '_').replace('(', '').replace(')', '') for col in original_columns]
-        df.columns = cleaned_columns
-
-        rename_map = {
-            'CLAVE': 'CLAVE_NODO_P',
-            'ENTIDAD_FEDERATIVA_INEGI': 'ESTADO',
-            'MUNICIPIO_INEGI': 'MUNICIPIO',
-            'SISTEMA': 'SISTEMA'
-        }
 
-        df = df.rename(columns={k: v for k, v in rename_map.items() if k in df.columns})
-
-        required_columns_after_rename = ['CLAVE_NODO_P', 'ESTADO', 'MUNICIPIO', 'SISTEMA']
-        for col in required_columns_after_rename:
-            if col not in df.columns:
-                return pd.DataFrame()
-        return df
-    except FileNotFoundError:
-        return pd.DataFrame()
-    except Exception:
-        return pd.DataFrame()
+# --- Caché compartido de resultados derivados: cambiar de vista entre consultas ya hechas no recalcula nada ---
+@st.cache_resource
+def get_vistas_cache():
+    return VistasCache()
 
 
 # --- Interfaz de Streamlit ---
@@ -260,47 +110,49 @@ st.sidebar.markdown(
 uploaded_file = st.sidebar.file_uploader("Sube el archivo (CSV o XLSX) del catálogo", type=["csv", "xlsx"])
 
 
-nodos_df = pd.DataFrame()
+nodos_index = NodosIndex(pd.DataFrame())
 
 default_catalogo_path = "Catalogo Nodos P.csv"
 try:
     if uploaded_file is not None:
-        nodos_df = load_nodos_catalogo(uploaded_file)
-        if nodos_df.empty:
+        nodos_index = load_nodos_catalogo(uploaded_file)
+        if nodos_index.empty:
             st.sidebar.warning("El catálogo subido está vacío o no es válido. Intentando cargar el predeterminado.")
             try:
-                nodos_df = load_nodos_catalogo(default_catalogo_path)
+                nodos_index = load_nodos_catalogo(default_catalogo_path)
             except FileNotFoundError:
                 pass
     else:
         try:
-            nodos_df = load_nodos_catalogo(default_catalogo_path)
+            nodos_index = load_nodos_catalogo(default_catalogo_path)
         except FileNotFoundError:
             pass
 
 except Exception:
     pass
 
-if nodos_df.empty:
+if nodos_index.empty:
     st.success("<--- Cargar un catálogo de nodos P válido. Por favor, sube un archivo CSV o XLSX desde la barra lateral.")
     st.stop()
 
 # --- SELECTORES DE FILTRO ---
-estados = sorted(nodos_df['ESTADO'].unique().tolist()) if 'ESTADO' in nodos_df.columns else []
-selected_estado = st.sidebar.selectbox("Seleccionar Estado", ["Todos los Estados"] + estados)
+# Todas las listas salen del índice precalculado del catálogo; los nodos se limitan al sistema elegido
+sistemas_disponibles = nodos_index.sistemas or ["SIN", "BCA", "BCS"]
+selected_sistema = st.sidebar.selectbox("Seleccionar Sistema", sistemas_disponibles)
+
+selected_estado = st.sidebar.selectbox("Seleccionar Estado", ["Todos los Estados"] + nodos_index.estados)
 
 municipios = []
-if selected_estado != "Todos los Estados" and 'MUNICIPIO' in nodos_df.columns:
-    municipios = sorted(nodos_df[nodos_df['ESTADO'] == selected_estado]['MUNICIPIO'].unique().tolist())
+if selected_estado != "Todos los Estados":
+    municipios = nodos_index.municipios(selected_estado)
 selected_municipio = st.sidebar.selectbox("Seleccionar Municipio", ["Todos los Municipios"] + municipios)
 
-nodos_filtrados_por_ubicacion = []
-if selected_estado != "Todos los Estados" and selected_municipio != "Todos los Municipios" and 'CLAVE_NODO_P' in nodos_df.columns:
-    nodos_filtrados_por_ubicacion = sorted(nodos_df[(nodos_df['ESTADO'] == selected_estado) & (nodos_df['MUNICIPIO'] == selected_municipio)]['CLAVE_NODO_P'].unique().tolist())
-elif selected_estado != "Todos los Estados" and selected_municipio == "Todos los Municipios" and 'CLAVE_NODO_P' in nodos_df.columns:
-    nodos_filtrados_por_ubicacion = sorted(nodos_df[nodos_df['ESTADO'] == selected_estado]['CLAVE_NODO_P'].unique().tolist())
-elif selected_estado == "Todos los Estados" and 'CLAVE_NODO_P' in nodos_df.columns:
-    nodos_filtrados_por_ubicacion = sorted(nodos_df['CLAVE_NODO_P'].unique().tolist())
+if selected_estado == "Todos los Estados":
+    nodos_filtrados_por_ubicacion = nodos_index.nodos(sistema=selected_sistema)
+elif selected_municipio == "Todos los Municipios":
+    nodos_filtrados_por_ubicacion = nodos_index.nodos(selected_estado, sistema=selected_sistema)
+else:
+    nodos_filtrados_por_ubicacion = nodos_index.nodos(selected_estado, selected_municipio, sistema=selected_sistema)
 
 selected_nodo_option_label = "Selecciona un Nodo Individual"
 if selected_municipio != "Todos los Municipios":
@@ -322,15 +174,20 @@ else:
     consulta_nivel_individual_nodo = True
 
 
-if 'SISTEMA' in nodos_df.columns and not nodos_df['SISTEMA'].empty:
-    sistemas_disponibles = sorted(nodos_df['SISTEMA'].unique().tolist())
-else:
-    sistemas_disponibles = ["SIN", "BCA", "BCS"]
-selected_sistema = st.sidebar.selectbox("Seleccionar Sistema", sistemas_disponibles)
-
 procesos = ["MDA", "MTR"]
 selected_proceso = st.sidebar.selectbox("Seleccionar Proceso", procesos)
 
+max_consultas_simultaneas = st.sidebar.slider("Consultas simultáneas", min_value=1, max_value=32, value=MAX_CONSULTAS_SIMULTANEAS,
+                                              help="Consultas de esta sesión al mismo tiempo; el total de todas las sesiones está limitado por el servidor.")
+conservar_datos_brutos = st.sidebar.checkbox("Conservar datos brutos para descarga", value=False,
+                                             help="En consultas de varios nodos solo se guardan los promedios; activa esta opción para poder descargar todas las filas.")
+usar_almacen_local = st.sidebar.checkbox("Usar almacén local de PML", value=True,
+                                         help="Reutiliza los nodos-día ya descargados y solo consulta al CENACE los faltantes.")
+mostrar_diagnostico = st.sidebar.checkbox("Mostrar diagnóstico", value=False,
+                                         help="Tiempos por etapa, bytes descargados, filas procesadas y errores por nodo de la consulta.")
+formato_exportacion = st.sidebar.selectbox("Formato de descarga", list(FORMATOS_EXPORTACION),
+                                           help="Parquet conserva los tipos de columna; el CSV se descarga comprimido.")
+
 st.sidebar.subheader("Rango de Fechas")
 fecha_actual = datetime.now()
 if fecha_actual.day < 3:
@@ -342,8 +199,258 @@ else:
 fecha_inicio = st.sidebar.date_input("Fecha de Inicio", (fecha_fin_default - pd.Timedelta(days=6)).date())
 fecha_fin = st.sidebar.date_input("Fecha de Fin", fecha_fin_default.date())
 
+# Nivel de agrupación de la gráfica de promedios
+group_cols = ['fecha_hora']
+if selected_municipio != "Todos los Municipios":
+    group_cols.extend(['ESTADO', 'MUNICIPIO'])
+elif selected_estado != "Todos los Estados":
+    group_cols.append('ESTADO')
+conservar_filas = consulta_nivel_individual_nodo or conservar_datos_brutos
+
+# Parámetros y nivel de agrupación de la consulta: con la misma clave se reutilizan sus resultados y vistas
+clave_consulta = (selected_sistema, selected_proceso, fecha_inicio, fecha_fin, selected_estado, selected_municipio,
+                  selected_nodo, tuple(nodos_a_consultar), conservar_filas)
+
 status_message_placeholder = st.empty()
 progress_bar_placeholder = st.empty()
+cancel_placeholder = st.empty()
+resultados_parciales_placeholder = st.empty()
+
+
+def grafica_nodo_individual(pml_df_processed, metrics=None):
+    """Gráfica de línea de un nodo; regresa (gráfica, número de puntos dibujados)."""
+    # Solo la gráfica usa la serie reducida; tablas y descargas conservan todos los datos
+    with medir(metrics, "reduccion_grafica"):
+        chart_df = downsample_min_max(pml_df_processed, 'fecha_hora', 'pml')
+    chart_df = chart_df.assign(**dict(zip(['fecha', 'hora'], fecha_hora_original(chart_df['fecha_hora']))))
+    chart = alt.Chart(chart_df).mark_line(point=True).encode(
+        x=alt.X('fecha_hora', axis=alt.Axis(title='Fecha y Hora', format='%Y-%m-%d %H:%M')),
+        y=alt.Y('pml', title='Precio Marginal Local (PML)'),
+        tooltip=[
+            alt.Tooltip('fecha', title='Fecha Original API'),
+            alt.Tooltip('hora', title='Hora Original API'),
+            alt.Tooltip('fecha_hora', title='Timestamp Corregido'),
+            alt.Tooltip('pml', title='PML', format='$.2f'), # Formato de moneda
+            alt.Tooltip('pml_ene', title='PML_ENE', format='$.2f'), # Formato de moneda
+            alt.Tooltip('pml_per', title='PML_PER', format='$.2f'), # Formato de moneda
+            alt.Tooltip('pml_cng', title='PML_CNG', format='$.2f') # Formato de moneda
+        ]
+    ).properties(
+        title=f"PML por Hora para {selected_nodo}"
+    ).interactive()
+    return chart, len(chart_df)
+
+
+def grafica_promedio(average_pml_df, group_cols, metrics=None):
+    """Gráfica del PML promedio por hora; regresa (gráfica, número de puntos dibujados)."""
+    tooltip_cols = [
+        alt.Tooltip('fecha_hora', title='Timestamp', format='%Y-%m-%d %H:%M'),
+        alt.Tooltip('pml_promedio', title='PML Promedio', format='$.2f') # Formato de moneda
+    ]
+
+    if selected_municipio != "Todos los Municipios":
+        title_suffix = f"para {selected_municipio} ({selected_estado})"
+        tooltip_cols.append(alt.Tooltip('MUNICIPIO'))
+    elif selected_estado != "Todos los Estados":
+        title_suffix = f"para {selected_estado}"
+        tooltip_cols.append(alt.Tooltip('ESTADO'))
+    else:
+        title_suffix = "para todos los nodos"
+
+    with medir(metrics, "reduccion_grafica"):
+        chart_avg_df = downsample_min_max(average_pml_df, 'fecha_hora', 'pml_promedio', group_cols=group_cols[1:])
+    chart_avg = alt.Chart(chart_avg_df).mark_line(point=True).encode(
+        x=alt.X('fecha_hora', axis=alt.Axis(title='Fecha y Hora', format='%Y-%m-%d %H:%M')),
+        y=alt.Y('pml_promedio', title='PML Promedio'),
+        tooltip=tooltip_cols
+    ).properties(
+        title=f"PML Promedio por Hora {title_suffix}"
+    ).interactive()
+    return chart_avg, len(chart_avg_df)
+
+
+def tabla_resumen_por_estado(aggregator):
+    pml_summary_by_state = aggregator.resumen_por_estado()
+    if pml_summary_by_state.empty:
+        return None
+    pml_summary_by_state.columns = ['Estado', 'PML Promedio', 'PML Máximo', 'PML Mínimo']
+    pml_summary_by_state = pml_summary_by_state.sort_values('PML Promedio', ascending=False).reset_index(drop=True)
+    # Formato de moneda para la tabla resumen
+    return pml_summary_by_state.style.format({
+        'PML Promedio': '${:.2f}',
+        'PML Máximo': '${:.2f}',
+        'PML Mínimo': '${:.2f}'
+    })
+
+
+def concatenar_filas(all_pml_data):
+    # Las filas ya traen fecha_hora (con la corrección de la hora 24), ESTADO y MUNICIPIO
+    return pd.concat(all_pml_data, ignore_index=True).sort_values(by=['fecha_hora']).reset_index(drop=True)
+
+
+def mostrar_resultados_parciales(consulta_pml):
+    """Redibuja la gráfica y el resumen con lo recibido hasta ahora, en su placeholder."""
+    aggregator = consulta_pml['aggregator']
+    with consulta_pml['metrics'].medir("vista_previa"), resultados_parciales_placeholder.container():
+        st.caption(f"Resultados parciales: {consulta_pml['consultas_terminadas']} de {consulta_pml['total_consultas']} "
+                   f"consulta(s) al CENACE, {aggregator.filas:,} filas.")
+        if consulta_pml['individual']:
+            if consulta_pml['all_pml_data']:
+                chart, _ = grafica_nodo_individual(concatenar_filas(consulta_pml['all_pml_data']))
+                st.altair_chart(chart, use_container_width=True)
+        else:
+            chart_avg, _ = grafica_promedio(aggregator.promedio_por_hora(), consulta_pml['group_cols'])
+            st.altair_chart(chart_avg, use_container_width=True)
+        resumen = tabla_resumen_por_estado(aggregator)
+        if resumen is not None:
+            st.dataframe(resumen)
+
+
+def vista_derivada(clave, nombre, calcular):
+    """Resultado de calcular() guardado en el caché compartido; sin clave (consulta cancelada) no se guarda."""
+    if clave is None:
+        return calcular()
+    return get_vistas_cache().obtener(('vista', clave, nombre), calcular)
+
+
+def mostrar_resultados(consulta_pml, usar_cache=False):
+    aggregator = consulta_pml['aggregator']
+    clave = consulta_pml['clave_vistas'] if usar_cache else None
+    failed_requests = consulta_pml['failed_requests']
+    metrics = consulta_pml['metrics']
+
+    if consulta_pml['cancelada']:
+        st.warning(f"Consulta cancelada: se muestran los datos de {consulta_pml['consultas_terminadas']} de "
+                   f"{consulta_pml['total_consultas']} consulta(s) al CENACE.")
+
+    if failed_requests:
+        fallas_df = metrics.errores_df()
+        st.warning(f"No se pudieron obtener datos para {fallas_df['clv_nodo'].nunique()} nodo(s) en {len(failed_requests)} consulta(s) después de {consulta_pml['max_retries']} intentos.")
+        with st.expander("Ver consultas fallidas"):
+            st.dataframe(fallas_df)
+
+    if aggregator.filas == 0:
+        st.warning("No se encontraron datos PML para los parámetros seleccionados.")
+        return
+
+    pml_df_processed = None
+    if consulta_pml['all_pml_data']:
+        pml_df_processed = vista_derivada(clave, 'filas', partial(concatenar_filas, consulta_pml['all_pml_data']))
+    average_pml_df = None
+
+    # --- Lógica para mostrar promedio o individual ---
+    if consulta_pml['individual']:
+        st.subheader(f"Gráfica Interactiva de PML para el Nodo: {selected_nodo} ({selected_estado}, {selected_municipio})")
+
+        chart, puntos_grafica = vista_derivada(clave, 'grafica', partial(grafica_nodo_individual, pml_df_processed, metrics))
+        with metrics.medir("grafica_altair"):
+            st.altair_chart(chart, use_container_width=True)
+        if puntos_grafica < len(pml_df_processed):
+            st.caption(f"Gráfica reducida a {puntos_grafica:,} de {len(pml_df_processed):,} puntos (mínimo y máximo por intervalo).")
+
+        st.subheader(f"Datos PML para el Nodo: {selected_nodo}")
+        st.write("A continuación se muestran los datos obtenidos:")
+        # Formatear la tabla directamente para PML con moneda
+        st.dataframe(pml_df_processed.style.format({
+            'pml': '${:.2f}',
+            'pml_ene': '${:.2f}',
+            'pml_per': '${:.2f}',
+            'pml_cng': '${:.2f}'
+        }))
+
+    else: # Se seleccionó "Todos los Nodos..." a nivel de estado, municipio o general
+        st.subheader(f"Gráfica Interactiva de PML Promedio por Hora para {selected_nodo}")
+
+        with metrics.medir("agregacion"):
+            average_pml_df = vista_derivada(clave, 'promedio', aggregator.promedio_por_hora)
+        chart_avg, puntos_grafica = vista_derivada(
+            clave, 'grafica', partial(grafica_promedio, average_pml_df, consulta_pml['group_cols'], metrics))
+        with metrics.medir("grafica_altair"):
+            st.altair_chart(chart_avg, use_container_width=True)
+        if puntos_grafica < len(average_pml_df):
+            st.caption(f"Gráfica reducida a {puntos_grafica:,} de {len(average_pml_df):,} puntos (mínimo y máximo por intervalo).")
+
+        st.subheader("Datos PML Promedio por Hora:")
+        # Formatear la tabla directamente para PML promedio con moneda
+        st.dataframe(average_pml_df.style.format({
+            'pml_promedio': '${:.2f}'
+        }))
+
+
+    # --- Tabla de PML Promedio, Máximo y Mínimo por Estado (para el periodo completo) ---
+    st.subheader("PML Resumen por Estado (Periodo Seleccionado)")
+    with metrics.medir("agregacion"):
+        resumen = vista_derivada(clave, 'resumen', partial(tabla_resumen_por_estado, aggregator))
+    if resumen is not None:
+        st.dataframe(resumen)
+    else:
+        st.warning("La columna 'ESTADO' no se encontró en los datos PML para generar el resumen por estado.")
+
+    # --- Opciones de Descarga ---
+    # El archivo se genera hasta que se hace clic (data recibe una función), no en cada ejecución
+    extension, mime_exportacion = FORMATOS_EXPORTACION[formato_exportacion]
+    sufijo_archivo = f"{selected_nodo.replace(' ', '_')}_{fecha_inicio.strftime('%Y%m%d')}_to_{fecha_fin.strftime('%Y%m%d')}{extension}"
+    if pml_df_processed is not None:
+        st.download_button(
+            label=f"Descargar datos PML brutos ({formato_exportacion})",
+            data=partial(export_frame, pml_df_processed, formato_exportacion),
+            file_name=f"pml_data_raw_{sufijo_archivo}",
+            mime=mime_exportacion,
+            on_click="ignore",
+        )
+    else:
+        st.info("Activa 'Conservar datos brutos para descarga' en la barra lateral para descargar todas las filas.")
+    if average_pml_df is not None:
+        st.download_button(
+            label=f"Descargar PML Promedio por Hora ({formato_exportacion})",
+            data=partial(export_frame, average_pml_df, formato_exportacion),
+            file_name=f"pml_promedio_hora_{sufijo_archivo}",
+            mime=mime_exportacion,
+            on_click="ignore",
+        )
+
+
+def mostrar_panel_diagnostico(metrics):
+    st.subheader("Diagnóstico de la consulta")
+    resumen = metrics.to_dict()
+    contadores = resumen['contadores']
+    columnas = st.columns(6)
+    columnas[0].metric("Duración", f"{resumen['duracion_s']:.1f} s")
+    columnas[1].metric("Consultas", f"{contadores.get('consultas', 0):,}")
+    columnas[2].metric("Reintentos", f"{contadores.get('reintentos', 0):,}")
+    columnas[3].metric("Descargado", f"{contadores.get('bytes_descargados', 0) / 2**20:,.2f} MB")
+    columnas[4].metric("Filas", f"{contadores.get('filas_parseadas', 0) + contadores.get('filas_almacen', 0):,}")
+    columnas[5].metric("Nodos con error", f"{resumen['nodos_con_error']:,}")
+    if contadores.get('consultas_compartidas'):
+        st.caption(f"{contadores['consultas_compartidas']:,} consulta(s) se tomaron de descargas en curso de otras sesiones.")
+    planificador = get_cenace_scheduler().estado()
+    if planificador['circuito_abierto']:
+        st.caption(f"Circuito abierto: el CENACE falló {planificador['fallas_seguidas']} veces seguidas y las consultas están suspendidas.")
+
+    st.caption("Tiempo acumulado por etapa; las etapas de descarga suman el tiempo de todas las consultas simultáneas.")
+    st.dataframe(metrics.tiempos().style.format({'segundos': '{:.3f}'}), hide_index=True)
+    cache = get_vistas_cache().estado()
+    st.caption(f"Caché de vistas: {cache['entradas']} entrada(s), {cache['mb']:,.1f} de {cache['mb_max']:,.0f} MB; "
+               f"{cache['aciertos']:,} acierto(s) y {cache['fallos']:,} fallo(s).")
+    if resumen['errores_por_categoria']:
+        st.dataframe(pd.Series(resumen['errores_por_categoria'], name='nodos').rename_axis('categoria').reset_index(),
+                     hide_index=True)
+
+
+def cerrar_consulta(consulta_pml):
+    """Registra la consulta en la bitácora y, si se pidió, muestra el panel de diagnóstico."""
+    consulta_pml['metrics'].log(cancelada=consulta_pml['cancelada'], **consulta_pml['contexto'])
+    if mostrar_diagnostico:
+        mostrar_panel_diagnostico(consulta_pml['metrics'])
+
+
+# Una consulta cancelada se conserva en session_state para mostrar lo que ya se había recibido
+consulta_cancelada = st.session_state.get("cancelar_consulta") and "consulta_pml" in st.session_state
+if consulta_cancelada:
+    consulta_pml = st.session_state.pop("consulta_pml")
+    consulta_pml['cancelada'] = True
+    mostrar_resultados(consulta_pml)
+    cerrar_consulta(consulta_pml)
 
 if st.sidebar.button("Obtener Datos PML"):
     if not nodos_a_consultar:
@@ -355,172 +462,81 @@ if st.sidebar.button("Obtener Datos PML"):
     else:
         status_message_placeholder.info(f"Obteniendo datos para {len(nodos_a_consultar)} nodo(s) seleccionado(s)... Esto puede tardar.")
         progress_bar = progress_bar_placeholder.progress(0)
-        all_pml_data = []
-        fetcher = CenacePMLFetcher()
-
-        for i, nodo in enumerate(nodos_a_consultar):
-            raw_data = fetcher.fetch_pml_data(selected_sistema, selected_proceso, [nodo], fecha_inicio.strftime("%Y-%m-%d"), fecha_fin.strftime("%Y-%m-%d"), formato="JSON")
-
-            if raw_data is not None:
-                if isinstance(raw_data, dict) or isinstance(raw_data, list):
-                    pml_data = fetcher.process_json_response(raw_data)
-                    if pml_data:
-                        all_pml_data.extend(pml_data)
-                elif ET.iselement(raw_data):
-                    pml_data = fetcher.process_xml_response(raw_data)
-                    if pml_data:
-                        all_pml_data.extend(pml_data)
-            progress_bar.progress((i + 1) / len(nodos_a_consultar))
+        # Al hacer clic se interrumpe esta ejecución; lo recibido queda en st.session_state.consulta_pml
+        cancel_placeholder.button("Cancelar consulta", key="cancelar_consulta")
+        fetcher = CenacePMLFetcher(max_workers=max_consultas_simultaneas, store=get_pml_store() if usar_almacen_local else None,
+                                   scheduler=get_cenace_scheduler())
+        fecha_inicio_str = fecha_inicio.strftime("%Y-%m-%d")
+        fecha_fin_str = fecha_fin.strftime("%Y-%m-%d")
+
+        # Los nodos-día faltantes se agrupan en lotes de acuerdo con los límites del servicio
+        consultas = fetcher.plan_missing_requests(selected_sistema, selected_proceso, nodos_a_consultar, fecha_inicio_str, fecha_fin_str)
+
+        # Los promedios y el resumen por estado se acumulan conforme llega cada respuesta;
+        # las filas brutas solo se conservan si se van a graficar (nodo individual) o descargar
+        consulta_pml = {
+            'aggregator': PMLAggregator(group_cols[1:]),
+            'all_pml_data': [],  # Un DataFrame por consulta, solo si se conservan las filas
+            'failed_requests': fetcher.failed_requests,
+            'max_retries': fetcher.max_retries,
+            'metrics': fetcher.metrics,
+            'group_cols': group_cols,
+            'individual': consulta_nivel_individual_nodo,
+            'consultas_terminadas': 0,
+            'total_consultas': len(consultas),
+            'cancelada': False,
+            # Única por ejecución: las vistas de una consulta anterior con los mismos parámetros no se reutilizan
+            'clave_vistas': clave_consulta + (time.time_ns(),),
+            'contexto': {'sistema': selected_sistema, 'proceso': selected_proceso, 'nodos': len(nodos_a_consultar),
+                         'fecha_inicio': fecha_inicio_str, 'fecha_fin': fecha_fin_str},
+        }
+        st.session_state.consulta_pml = consulta_pml
 
+        # Primero se lee lo que ya está en el almacén local y luego llegan las consultas en paralelo;
+        # el procesamiento, la barra de progreso y la vista previa se actualizan en este hilo
+        resultados = fetcher.iter_pml_frames(selected_sistema, selected_proceso, nodos_a_consultar, fecha_inicio_str, fecha_fin_str, consultas, formato="JSON")
+        ultima_vista_previa = None
+        try:
+            for consulta, pml_data in resultados:
+                # Forma compacta: códigos categóricos, un solo timestamp y precios float32
+                pml_compacto = nodos_index.compact_frame(pml_data, fetcher.metrics)
+                with fetcher.metrics.medir("agregacion"):
+                    consulta_pml['aggregator'].update(pml_compacto)
+                if conservar_filas and not pml_compacto.empty:
+                    consulta_pml['all_pml_data'].append(pml_compacto)
+                if consulta is not None:
+                    consulta_pml['consultas_terminadas'] += 1
+                    progress_bar.progress(consulta_pml['consultas_terminadas'] / len(consultas))
+
+                # La vista previa se redibuja a lo más cada INTERVALO_VISTA_PREVIA segundos
+                if consulta_pml['aggregator'].filas > 0 and (
+                        ultima_vista_previa is None or time.monotonic() - ultima_vista_previa >= INTERVALO_VISTA_PREVIA):
+                    mostrar_resultados_parciales(consulta_pml)
+                    ultima_vista_previa = time.monotonic()
+        finally:
+            # Al cancelar, Streamlit interrumpe la ejecución aquí: se dejan de lanzar las consultas pendientes
+            resultados.close()
+
+        del st.session_state.consulta_pml
         status_message_placeholder.empty()
         progress_bar_placeholder.empty()
+        cancel_placeholder.empty()
+        resultados_parciales_placeholder.empty()
 
-        if all_pml_data:
-            pml_df = pd.DataFrame(all_pml_data)
-
-            # --- Corrección para '24:00:00' y creación de 'fecha_hora' ---
-            pml_df_processed = pml_df.copy()
-
-            pml_df_processed['hora_int'] = pd.to_numeric(pml_df_processed['hora'], errors='coerce').fillna(0).astype(int)
-            pml_df_processed['fecha_dt'] = pd.to_datetime(pml_df_processed['fecha'], errors='coerce')
-
-            mask_hora_24 = pml_df_processed['hora_int'] == 24
-            pml_df_processed.loc[mask_hora_24, 'hora_int'] = 0
-            pml_df_processed.loc[mask_hora_24, 'fecha_dt'] += timedelta(days=1)
-
-            pml_df_processed['hora_str_formatted'] = pml_df_processed['hora_int'].astype(str).str.zfill(2)
-            pml_df_processed['fecha_hora'] = pd.to_datetime(
-                pml_df_processed['fecha_dt'].dt.strftime('%Y-%m-%d') + ' ' + pml_df_processed['hora_str_formatted'] + ':00:00',
-                format='%Y-%m-%d %H:%M:%S',
-                errors='coerce'
-            )
-            pml_df_processed = pml_df_processed.dropna(subset=['fecha_hora'])
-
-            pml_df_processed['pml'] = pd.to_numeric(pml_df_processed['pml'], errors='coerce')
-            pml_df_processed = pml_df_processed.dropna(subset=['pml'])
-            pml_df_processed = pml_df_processed.sort_values(by=['fecha_hora']).reset_index(drop=True)
-            # --- Fin de la corrección ---
-
-            # Unir con información de ubicación del catálogo de nodos
-            pml_df_merged = pml_df_processed.merge(nodos_df[['CLAVE_NODO_P', 'ESTADO', 'MUNICIPIO']],
-                                                   left_on='clv_nodo',
-                                                   right_on='CLAVE_NODO_P',
-                                                   how='left')
-            pml_df_merged.drop(columns=['CLAVE_NODO_P'], inplace=True)
-
-
-            # --- Lógica para mostrar promedio o individual ---
-            if consulta_nivel_individual_nodo:
-                st.subheader(f"Gráfica Interactiva de PML para el Nodo: {selected_nodo} ({selected_estado}, {selected_municipio})")
-
-                chart = alt.Chart(pml_df_merged).mark_line(point=True).encode(
-                    x=alt.X('fecha_hora', axis=alt.Axis(title='Fecha y Hora', format='%Y-%m-%d %H:%M')),
-                    y=alt.Y('pml', title='Precio Marginal Local (PML)'),
-                    tooltip=[
-                        alt.Tooltip('fecha', title='Fecha Original API'),
-                        alt.Tooltip('hora', title='Hora Original API'),
-                        alt.Tooltip('fecha_hora', title='Timestamp Corregido'),
-                        alt.Tooltip('pml', title='PML', format='$.2f'), # Formato de moneda
-                        alt.Tooltip('pml_ene', title='PML_ENE', format='$.2f'), # Formato de moneda
-                        alt.Tooltip('pml_per', title='PML_PER', format='$.2f'), # Formato de moneda
-                        alt.Tooltip('pml_cng', title='PML_CNG', format='$.2f') # Formato de moneda
-                    ]
-                ).properties(
-                    title=f"PML por Hora para {selected_nodo}"
-                ).interactive()
-
-                st.altair_chart(chart, use_container_width=True)
-
-                st.subheader(f"Datos PML para el Nodo: {selected_nodo}")
-                st.write("A continuación se muestran los datos obtenidos:")
-                # Formatear la tabla directamente para PML con moneda
-                st.dataframe(pml_df_merged.drop(columns=['fecha_dt', 'hora_int', 'hora_str_formatted']).style.format({
-                    'pml': '${:.2f}',
-                    'pml_ene': '${:.2f}',
-                    'pml_per': '${:.2f}',
-                    'pml_cng': '${:.2f}'
-                }))
-
-            else: # Se seleccionó "Todos los Nodos..." a nivel de estado, municipio o general
-                st.subheader(f"Gráfica Interactiva de PML Promedio por Hora para {selected_nodo}")
-
-                group_cols = ['fecha_hora']
-                title_suffix = ""
-                tooltip_cols = [
-                    alt.Tooltip('fecha_hora', title='Timestamp', format='%Y-%m-%d %H:%M'),
-                    alt.Tooltip('pml_promedio', title='PML Promedio', format='$.2f') # Formato de moneda
-                ]
-
-                if selected_municipio != "Todos los Municipios":
-                    group_cols.extend(['ESTADO', 'MUNICIPIO'])
-                    title_suffix = f"para {selected_municipio} ({selected_estado})"
-                    tooltip_cols.append(alt.Tooltip('MUNICIPIO'))
-                elif selected_estado != "Todos los Estados":
-                    group_cols.append('ESTADO')
-                    title_suffix = f"para {selected_estado}"
-                    tooltip_cols.append(alt.Tooltip('ESTADO'))
-                else:
-                    title_suffix = "para todos los nodos"
-
-                average_pml_df = pml_df_merged.groupby(group_cols)['pml'].mean().reset_index()
-                average_pml_df.columns = group_cols + ['pml_promedio']
-
-                chart_avg = alt.Chart(average_pml_df).mark_line(point=True).encode(
-                    x=alt.X('fecha_hora', axis=alt.Axis(title='Fecha y Hora', format='%Y-%m-%d %H:%M')),
-                    y=alt.Y('pml_promedio', title='PML Promedio'),
-                    tooltip=tooltip_cols
-                ).properties(
-                    title=f"PML Promedio por Hora {title_suffix}"
-                ).interactive()
-
-                st.altair_chart(chart_avg, use_container_width=True)
-
-                st.subheader("Datos PML Promedio por Hora:")
-                # Formatear la tabla directamente para PML promedio con moneda
-                st.dataframe(average_pml_df.style.format({
-                    'pml_promedio': '${:.2f}'
-                }))
-
-
-            # --- Tabla de PML Promedio, Máximo y Mínimo por Estado (para el periodo completo) ---
-            st.subheader("PML Resumen por Estado (Periodo Seleccionado)")
-            if 'ESTADO' in pml_df_merged.columns:
-                pml_summary_by_state = pml_df_merged.groupby('ESTADO')['pml'].agg(
-                    PML_Promedio='mean',
-                    PML_Maximo='max',
-                    PML_Minimo='min'
-                ).reset_index()
-                pml_summary_by_state.columns = ['Estado', 'PML Promedio', 'PML Máximo', 'PML Mínimo']
-                pml_summary_by_state = pml_summary_by_state.sort_values('PML Promedio', ascending=False).reset_index(drop=True)
-                # Formato de moneda para la tabla resumen
-                st.dataframe(pml_summary_by_state.style.format({
-                    'PML Promedio': '${:.2f}',
-                    'PML Máximo': '${:.2f}',
-                    'PML Mínimo': '${:.2f}'
-                }))
-            else:
-                st.warning("La columna 'ESTADO' no se encontró en los datos PML para generar el resumen por estado.")
-
-            # --- Opciones de Descarga ---
-            csv_export = pml_df_processed.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="Descargar datos PML brutos (CSV)",
-                data=csv_export,
-                file_name=f"pml_data_raw_{selected_nodo.replace(' ', '_')}_{fecha_inicio.strftime('%Y%m%d')}_to_{fecha_fin.strftime('%Y%m%d')}.csv",
-                mime="text/csv",
-            )
-            if not consulta_nivel_individual_nodo and 'average_pml_df' in locals():
-                csv_export_avg = average_pml_df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="Descargar PML Promedio por Hora (CSV)",
-                    data=csv_export_avg,
-                    file_name=f"pml_promedio_hora_{selected_nodo.replace(' ', '_')}_{fecha_inicio.strftime('%Y%m%d')}_to_{fecha_fin.strftime('%Y%m%d')}.csv",
-                    mime="text/csv",
-                )
-
-        else:
-            st.warning("No se encontraron datos PML para los parámetros seleccionados.")
+        # Completa, queda en el caché: los reruns con la misma selección la muestran sin volver a consultar
+        get_vistas_cache().guardar(('consulta', clave_consulta), consulta_pml)
+        mostrar_resultados(consulta_pml, usar_cache=True)
+        cerrar_consulta(consulta_pml)
     # Final de la lógica del botón "Obtener Datos PML"
+elif not consulta_cancelada:
+    # Cualquier otro widget provoca un rerun: si esta selección ya se consultó (en esta u otra sesión),
+    # sus resultados y vistas salen del caché
+    consulta_previa = get_vistas_cache().get(('consulta', clave_consulta))
+    if consulta_previa is not None:
+        st.caption("Resultados de una consulta anterior con estos parámetros; usa 'Obtener Datos PML' para actualizarlos.")
+        mostrar_resultados(consulta_previa, usar_cache=True)
+        if mostrar_diagnostico:
+            mostrar_panel_diagnostico(consulta_previa['metrics'])
 
 st.sidebar.markdown("---")
 st.sidebar.info("Desarrollado para la consulta de PML del CENACE.")
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""Respaldo masivo de PML del CENACE a Parquet, sin interfaz gráfica.
+
+Ejemplos:
+    python pml_backfill.py --sistema SIN --proceso MDA --nodos 01PLO-115 02HMO-230 \\
+        --fecha-inicio 2025-01-01 --fecha-fin 2025-03-31 --salida pml_parquet
+
+    python pml_backfill.py --sistema SIN --proceso MDA --catalogo "Catalogo Nodos P.csv" --estado SONORA \\
+        --fecha-inicio 2025-01-01 --fecha-fin 2025-01-31 --salida pml_parquet
+
+Cada consulta (lote de nodos x ventana de fechas) se escribe en su propio archivo Parquet
+dentro de salida/sistema=<SISTEMA>/proceso=<PROCESO>/. Al repetir el mismo comando se omiten
+los archivos que ya existen, así que una ejecución interrumpida se reanuda donde se quedó.
+
+Las consultas sin filas no se escriben y quedan pendientes. Las ventanas que llegan a hoy o
+después aún pueden cambiar (p. ej. MTR sin publicar), y a una respuesta truncada le faltan nodos
+u horas: en ambos casos se escriben como <archivo>.parcial.parquet, se vuelven a pedir en cada
+ejecución y se reemplazan por el archivo definitivo cuando la ventana ya pasó y está completa.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+from datetime import datetime
+
+from pml_core import (
+    MAX_CONSULTAS_SIMULTANEAS,
+    CenacePMLFetcher,
+    PMLStore,
+    build_fecha_hora,
+    configurar_bitacora,
+    nodo_dias_incompletos,
+    read_nodos_catalogo,
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Descarga PML del CENACE a archivos Parquet.")
+    parser.add_argument("--sistema", required=True, help="SIN, BCA o BCS")
+    parser.add_argument("--proceso", required=True, help="MDA o MTR")
+    parser.add_argument("--fecha-inicio", required=True, help="Fecha de inicio (AAAA-MM-DD)")
+    parser.add_argument("--fecha-fin", required=True, help="Fecha de fin (AAAA-MM-DD)")
+    parser.add_argument("--salida", required=True, help="Directorio de salida de los archivos Parquet")
+    parser.add_argument("--nodos", nargs="+", default=[], help="Claves de nodo a consultar")
+    parser.add_argument("--catalogo", help="Catálogo de nodos (CSV o XLSX) para elegir nodos por ubicación")
+    parser.add_argument("--estado", help="Filtrar el catálogo por estado")
+    parser.add_argument("--municipio", help="Filtrar el catálogo por municipio")
+    parser.add_argument("--formato", default="JSON", choices=["JSON", "XML"])
+    parser.add_argument("--max-workers", type=int, default=MAX_CONSULTAS_SIMULTANEAS, help="Consultas simultáneas")
+    parser.add_argument("--store", help="Guardar también en este almacén SQLite (el mismo que usa la aplicación)")
+    return parser.parse_args(argv)
+
+
+def resolve_nodos(args):
+    nodos = list(args.nodos)
+    if args.catalogo:
+        catalogo = read_nodos_catalogo(args.catalogo)
+        if catalogo.empty:
+            raise SystemExit(f"El catálogo {args.catalogo} está vacío o no es válido.")
+        catalogo = catalogo[catalogo['SISTEMA'] == args.sistema]
+        if args.estado:
+            catalogo = catalogo[catalogo['ESTADO'] == args.estado]
+        if args.municipio:
+            catalogo = catalogo[catalogo['MUNICIPIO'] == args.municipio]
+        nodos.extend(sorted(catalogo['CLAVE_NODO_P'].unique().tolist()))
+    return list(dict.fromkeys(nodos))
+
+
+def consulta_path(salida, sistema, proceso, consulta, parcial=False):
+    # Nombre determinista por consulta: el mismo plan produce los mismos archivos
+    lote, inicio, fin = consulta
+    lote_hash = hashlib.sha1("-".join(lote).encode("utf-8")).hexdigest()[:12]
+    directorio = os.path.join(salida, f"sistema={sistema}", f"proceso={proceso}")
+    sufijo = ".parcial.parquet" if parcial else ".parquet"
+    return os.path.join(directorio, f"{inicio}_{fin}_{lote_hash}{sufijo}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configurar_bitacora()
+    nodos = resolve_nodos(args)
+    if not nodos:
+        raise SystemExit("No hay nodos para consultar. Usa --nodos o --catalogo.")
+
+    fetcher = CenacePMLFetcher(max_workers=args.max_workers)
+    store = PMLStore(args.store) if args.store else None
+
+    consultas = fetcher.plan_requests(nodos, args.fecha_inicio, args.fecha_fin)
+    pendientes = [c for c in consultas if not os.path.exists(consulta_path(args.salida, args.sistema, args.proceso, c))]
+    print(f"{len(nodos)} nodo(s), {len(consultas)} consulta(s), {len(consultas) - len(pendientes)} ya descargada(s).",
+          file=sys.stderr)
+
+    hoy = datetime.now().strftime("%Y-%m-%d")
+    inicio_total = time.monotonic()
+    filas_total = 0
+    sin_datos = []
+    incompletas = []
+    resultados = fetcher.fetch_pml_data_concurrent(args.sistema, args.proceso, pendientes, formato=args.formato)
+    for i, (consulta, raw_data) in enumerate(resultados, start=1):
+        lote, inicio, fin = consulta
+        if raw_data is not None:
+            with fetcher.metrics.medir("parseo"):
+                pml_df = fetcher.process_response(raw_data)
+            fetcher.metrics.contar("filas_parseadas", len(pml_df))
+            with fetcher.metrics.medir("correccion_fecha_hora"):
+                pml_df['fecha_hora'] = build_fecha_hora(pml_df['fecha'], pml_df['hora'])
+
+            if pml_df.empty:
+                # Sin archivo: la ventana se vuelve a pedir en la siguiente ejecución
+                sin_datos.append(consulta)
+                estado = "sin datos, pendiente"
+            else:
+                # Una ventana que llega a hoy aún no es definitiva, y una con nodos u horas faltantes tampoco:
+                # se guarda como parcial y no cuenta como descargada
+                faltantes = nodo_dias_incompletos(args.sistema, pml_df, lote, inicio, fin)
+                parcial = fin >= hoy or bool(faltantes)
+                # Escribir a un temporal y renombrar: un archivo existente siempre está completo
+                path = consulta_path(args.salida, args.sistema, args.proceso, consulta, parcial=parcial)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with fetcher.metrics.medir("escritura_parquet"):
+                    pml_df.to_parquet(path + ".tmp", index=False)
+                    os.replace(path + ".tmp", path)
+                path_parcial = consulta_path(args.salida, args.sistema, args.proceso, consulta, parcial=True)
+                if not parcial and os.path.exists(path_parcial):
+                    os.remove(path_parcial)
+                if store is not None:
+                    with fetcher.metrics.medir("almacen_guardar"):
+                        store.save(args.sistema, args.proceso, pml_df)
+
+                filas_total += len(pml_df)
+                estado = f"{len(pml_df)} filas"
+                if fin < hoy and faltantes:
+                    incompletas.append((consulta, faltantes))
+                    estado += f" (incompleta: {len(faltantes)} nodo-día(s) sin todas sus horas, se vuelve a pedir)"
+                elif parcial:
+                    estado += " (parcial, se vuelve a pedir)"
+        else:
+            estado = "FALLÓ"
+        print(f"[{i}/{len(pendientes)}] {inicio} a {fin}, {len(lote)} nodo(s): {estado}", file=sys.stderr)
+
+    print(f"{filas_total} filas en {time.monotonic() - inicio_total:.1f} s.", file=sys.stderr)
+    print(fetcher.metrics.tiempos().to_string(index=False), file=sys.stderr)
+    fetcher.metrics.log(comando="pml_backfill", sistema=args.sistema, proceso=args.proceso, nodos=len(nodos),
+                        fecha_inicio=args.fecha_inicio, fecha_fin=args.fecha_fin, consultas_pendientes=len(pendientes))
+    if fetcher.failed_requests:
+        for lote, inicio, fin, error in fetcher.failed_requests:
+            print(f"Falló {inicio} a {fin} ({', '.join(lote)}): {error}", file=sys.stderr)
+    for lote, inicio, fin in sin_datos:
+        print(f"Sin datos {inicio} a {fin} ({', '.join(lote)}): pendiente", file=sys.stderr)
+    for (lote, inicio, fin), faltantes in incompletas:
+        nodos_faltantes = sorted({nodo for nodo, _ in faltantes})
+        print(f"Incompleta {inicio} a {fin} ({', '.join(nodos_faltantes)} sin todas sus horas): pendiente", file=sys.stderr)
+    if fetcher.failed_requests or sin_datos or incompletas:
+        print("Vuelve a ejecutar el mismo comando para reintentar las consultas fallidas, sin datos o incompletas.",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
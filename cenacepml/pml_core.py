@@ -0,0 +1,1180 @@
+"""Núcleo para obtener, procesar y almacenar PML del CENACE, sin dependencias de Streamlit.
+
+Lo usan la aplicación (cenacepml.py) y el respaldo por línea de comandos (pml_backfill.py).
+"""
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import warnings
+import xml.etree.ElementTree as ET
+import os
+import sqlite3
+import sys
+import gzip
+import json
+import logging
+import threading
+import time
+from array import array
+from contextlib import closing, contextmanager, nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+# Suprimir advertencias de SSL (solo para desarrollo, no recomendado en producción)
+warnings.filterwarnings('ignore', message='Unverified HTTPS request')
+
+CORE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bitácora del paquete; la aplicación y el respaldo la configuran con configurar_bitacora
+logger = logging.getLogger("cenacepml")
+
+# Número de consultas simultáneas por defecto contra el servicio del CENACE
+MAX_CONSULTAS_SIMULTANEAS = 8
+
+# Límites del servicio SW-PML por consulta: hasta 20 nodos y hasta 7 días
+MAX_NODOS_POR_CONSULTA = 20
+MAX_DIAS_POR_CONSULTA = 7
+
+# Tiempos de espera (conexión, lectura) en segundos y reintentos para errores transitorios
+TIMEOUT_CONEXION = 10
+TIMEOUT_LECTURA = 60
+MAX_REINTENTOS = 4
+
+# Puntos máximos por serie que se envían a la gráfica (aprox. dos por píxel de ancho)
+MAX_PUNTOS_GRAFICA = 2000
+
+# Límites del planificador compartido por todas las sesiones (CenaceScheduler)
+MAX_CONSULTAS_GLOBALES = 16
+SOLICITUDES_POR_SEGUNDO = 10
+# Consultas fallidas seguidas que abren el circuito y segundos que permanece abierto
+UMBRAL_FALLAS_CIRCUITO = 5
+ESPERA_CIRCUITO = 60
+
+# Ruta del almacén local de PML (se puede cambiar con la variable de entorno PML_STORE_PATH)
+PML_STORE_PATH = os.environ.get("PML_STORE_PATH", os.path.join(CORE_DIR, "pml_store.sqlite"))
+
+# Zona horaria de cada sistema: define cuántas horas trae un día (23 o 25 en los cambios de horario)
+ZONAS_HORARIAS_SISTEMA = {"SIN": "America/Mexico_City", "BCA": "America/Tijuana", "BCS": "America/Mazatlan"}
+
+PML_COLUMNAS = ["clv_nodo", "fecha", "hora", "pml", "pml_ene", "pml_per", "pml_cng"]
+
+# Formatos de descarga: extensión y tipo MIME; el CSV siempre va comprimido
+FORMATOS_EXPORTACION = {
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+    "CSV (gzip)": (".csv.gz", "application/gzip"),
+    "CSV (zstd)": (".csv.zst", "application/zstd"),
+}
+
+# Filas que se convierten y escriben por bloque al exportar
+FILAS_POR_BLOQUE_EXPORTACION = 100_000
+
+# Caché de vistas derivadas de consultas terminadas: presupuesto de memoria (PML_CACHE_VISTAS_MB) y vigencia en segundos
+CACHE_VISTAS_MB = float(os.environ.get("PML_CACHE_VISTAS_MB", 256))
+CACHE_VISTAS_TTL = 30 * 60
+
+
+class PMLColumnBuilder:
+    """Acumula filas de PML directamente en columnas tipadas, sin un dict por cada valor."""
+
+    def __init__(self):
+        self.clv_nodo = []
+        self.fecha = []
+        self.hora = array("i")
+        self.pml = array("d")
+        self.pml_ene = array("d")
+        self.pml_per = array("d")
+        self.pml_cng = array("d")
+
+    def __len__(self):
+        return len(self.hora)
+
+    def append(self, clv_nodo, fecha, hora, pml, pml_ene, pml_per, pml_cng):
+        self.clv_nodo.append(clv_nodo)
+        self.fecha.append(fecha)
+        self.hora.append(hora)
+        self.pml.append(pml)
+        self.pml_ene.append(pml_ene)
+        self.pml_per.append(pml_per)
+        self.pml_cng.append(pml_cng)
+
+    def to_frame(self):
+        return pd.DataFrame({
+            "clv_nodo": pd.Series(self.clv_nodo, dtype=object),
+            "fecha": pd.Series(self.fecha, dtype=object),
+            "hora": np.frombuffer(self.hora, dtype=np.int32),
+            "pml": np.frombuffer(self.pml, dtype=np.float64),
+            "pml_ene": np.frombuffer(self.pml_ene, dtype=np.float64),
+            "pml_per": np.frombuffer(self.pml_per, dtype=np.float64),
+            "pml_cng": np.frombuffer(self.pml_cng, dtype=np.float64),
+        }, columns=PML_COLUMNAS)
+
+
+def horas_del_dia(sistema, fecha):
+    """Horas que tiene el día fecha ('AAAA-MM-DD') en la zona horaria del sistema: 24, o 23/25 al cambiar de horario."""
+    zona = ZoneInfo(ZONAS_HORARIAS_SISTEMA.get(sistema, "America/Mexico_City"))
+    inicio = datetime.strptime(fecha, "%Y-%m-%d").replace(tzinfo=zona)
+    fin = (inicio + timedelta(days=1)).replace(tzinfo=zona)
+    return round((fin.timestamp() - inicio.timestamp()) / 3600)
+
+
+def nodo_dias_incompletos(sistema, pml_df, lista_nodos, fecha_inicio, fecha_fin):
+    """(nodo, fecha) de la consulta con menos horas en pml_df de las que tiene el día (o sin ninguna)."""
+    horas = pml_df.groupby(['clv_nodo', 'fecha'])['hora'].nunique().to_dict()
+    return [(nodo, fecha) for nodo in lista_nodos for fecha in _fechas_entre(fecha_inicio, fecha_fin)
+            if horas.get((nodo, fecha), 0) < horas_del_dia(sistema, fecha)]
+
+
+# --- Almacén local de PML ---
+class PMLStore:
+    """Almacén SQLite de PML por sistema/proceso/clv_nodo/fecha.
+
+    Los precios de días pasados no cambian, por lo que un nodo-día pasado con todas sus
+    horas se marca como completo y no se vuelve a pedir al CENACE; uno incompleto (respuesta
+    truncada) se vuelve a pedir hasta tener todas las horas.
+    """
+
+    def __init__(self, path=PML_STORE_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pml ("
+                " sistema TEXT NOT NULL, proceso TEXT NOT NULL, clv_nodo TEXT NOT NULL,"
+                " fecha TEXT NOT NULL, hora INTEGER NOT NULL,"
+                " pml REAL, pml_ene REAL, pml_per REAL, pml_cng REAL,"
+                " PRIMARY KEY (sistema, proceso, clv_nodo, fecha, hora))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pml_dias ("
+                " sistema TEXT NOT NULL, proceso TEXT NOT NULL, clv_nodo TEXT NOT NULL, fecha TEXT NOT NULL,"
+                " PRIMARY KEY (sistema, proceso, clv_nodo, fecha))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # Una conexión por operación: Streamlit atiende cada sesión en un hilo distinto.
+        # El with de la conexión confirma o revierte la transacción; closing la cierra al salir
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            yield conn
+
+    def missing_node_days(self, sistema, proceso, nodos, fecha_inicio, fecha_fin):
+        """Regresa {nodo: [fechas faltantes]} para el rango solicitado."""
+        start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
+        end_date = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+        fechas = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+        with self._connect() as conn:
+            completos = set(conn.execute(
+                "SELECT clv_nodo, fecha FROM pml_dias WHERE sistema = ? AND proceso = ? AND fecha BETWEEN ? AND ?",
+                (sistema, proceso, fecha_inicio, fecha_fin)
+            ).fetchall())
+
+        faltantes = {}
+        for nodo in dict.fromkeys(nodos):
+            dias = [fecha for fecha in fechas if (nodo, fecha.strftime("%Y-%m-%d")) not in completos]
+            if dias:
+                faltantes[nodo] = dias
+        return faltantes
+
+    def save(self, sistema, proceso, pml_df):
+        if pml_df.empty:
+            return
+        hoy = datetime.now().strftime("%Y-%m-%d")
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO pml (sistema, proceso, clv_nodo, fecha, hora, pml, pml_ene, pml_per, pml_cng)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((sistema, proceso) + fila for fila in zip(*(pml_df[col].tolist() for col in PML_COLUMNAS)))
+            )
+            # Solo los días pasados se consideran definitivos, y solo si ya están todas sus horas
+            # (contando las guardadas antes: una respuesta parcial se completa en otra consulta)
+            dias_pasados = pml_df.loc[pml_df["fecha"] < hoy, ["clv_nodo", "fecha"]].drop_duplicates()
+            conn.execute("CREATE TEMP TABLE dias_guardados (clv_nodo TEXT, fecha TEXT, PRIMARY KEY (clv_nodo, fecha))")
+            conn.executemany("INSERT INTO dias_guardados (clv_nodo, fecha) VALUES (?, ?)",
+                             dias_pasados.itertuples(index=False))
+            horas_por_dia = conn.execute(
+                "SELECT p.clv_nodo, p.fecha, COUNT(*) FROM pml p"
+                " JOIN dias_guardados d ON p.clv_nodo = d.clv_nodo AND p.fecha = d.fecha"
+                " WHERE p.sistema = ? AND p.proceso = ? GROUP BY p.clv_nodo, p.fecha",
+                (sistema, proceso)
+            ).fetchall()
+            conn.executemany(
+                "INSERT OR IGNORE INTO pml_dias (sistema, proceso, clv_nodo, fecha) VALUES (?, ?, ?, ?)",
+                ((sistema, proceso, nodo, fecha) for nodo, fecha, horas in horas_por_dia
+                 if horas >= horas_del_dia(sistema, fecha))
+            )
+
+    def load(self, sistema, proceso, nodos, fecha_inicio, fecha_fin, solo_completos=False):
+        """Lee los PML guardados; con solo_completos=True omite los nodos-día que aún pueden cambiar."""
+        filtro_completos = (
+            " AND EXISTS (SELECT 1 FROM pml_dias d WHERE d.sistema = p.sistema AND d.proceso = p.proceso"
+            " AND d.clv_nodo = p.clv_nodo AND d.fecha = p.fecha)"
+        ) if solo_completos else ""
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE consulta_nodos (clv_nodo TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO consulta_nodos (clv_nodo) VALUES (?)", [(nodo,) for nodo in nodos])
+            cursor = conn.execute(
+                "SELECT p.clv_nodo, p.fecha, p.hora, p.pml, p.pml_ene, p.pml_per, p.pml_cng"
+                " FROM pml p JOIN consulta_nodos n ON p.clv_nodo = n.clv_nodo"
+                " WHERE p.sistema = ? AND p.proceso = ? AND p.fecha BETWEEN ? AND ?" + filtro_completos,
+                (sistema, proceso, fecha_inicio, fecha_fin)
+            )
+            builder = PMLColumnBuilder()
+            for row in cursor:
+                builder.append(*row)
+            return builder.to_frame()
+
+
+class PMLAggregator:
+    """Acumula suma, cuenta, mínimo y máximo del PML conforme llegan las respuestas.
+
+    Recibe los DataFrames compactos de NodosIndex.compact_frame. Los acumuladores son por
+    fecha_hora (más group_cols) y por ESTADO, así que la memoria depende del número de horas
+    y grupos, no del número de nodos.
+    """
+
+    AGREGACION = {'suma': 'sum', 'cuenta': 'sum', 'minimo': 'min', 'maximo': 'max'}
+    ESTADISTICAS = dict(suma='sum', cuenta='count', minimo='min', maximo='max')
+
+    def __init__(self, group_cols=()):
+        self.group_cols = list(group_cols)
+        self.filas = 0
+        self._por_hora = None
+        self._por_estado = None
+
+    def _acumular(self, acumulado, parcial):
+        if acumulado is None:
+            return parcial
+        niveles = list(range(parcial.index.nlevels))
+        return pd.concat([acumulado, parcial]).groupby(level=niveles, observed=True).agg(self.AGREGACION)
+
+    def update(self, pml_compacto):
+        if pml_compacto.empty:
+            return
+        self._por_hora = self._acumular(
+            self._por_hora,
+            pml_compacto.groupby(['fecha_hora'] + self.group_cols, observed=True)['pml'].agg(**self.ESTADISTICAS))
+        self._por_estado = self._acumular(
+            self._por_estado,
+            pml_compacto.groupby('ESTADO', observed=True)['pml'].agg(**self.ESTADISTICAS))
+        self.filas += len(pml_compacto)
+
+    def promedio_por_hora(self):
+        """Mismo resultado que groupby(['fecha_hora'] + group_cols)['pml'].mean() sobre todas las filas."""
+        if self._por_hora is None:
+            return pd.DataFrame(columns=['fecha_hora'] + self.group_cols + ['pml_promedio'])
+        promedio = (self._por_hora['suma'] / self._por_hora['cuenta']).rename('pml_promedio')
+        return promedio.reset_index()
+
+    def resumen_por_estado(self):
+        if self._por_estado is None:
+            return pd.DataFrame(columns=['ESTADO', 'PML_Promedio', 'PML_Maximo', 'PML_Minimo'])
+        return pd.DataFrame({
+            'PML_Promedio': self._por_estado['suma'] / self._por_estado['cuenta'],
+            'PML_Maximo': self._por_estado['maximo'],
+            'PML_Minimo': self._por_estado['minimo'],
+        }).reset_index()
+
+
+# Conexión cortada o lectura agotada a media respuesta: requests las envuelve al leer el contenido,
+# pero al leer response.raw en streaming llegan directo de urllib3
+ERRORES_CORTE_RESPUESTA = (requests.exceptions.ChunkedEncodingError, urllib3.exceptions.ProtocolError)
+
+
+def es_error_transitorio(exc):
+    """Errores de red, tiempos de espera y respuestas 429/5xx se reintentan; el resto no."""
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        urllib3.exceptions.ReadTimeoutError) + ERRORES_CORTE_RESPUESTA):
+        return True
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
+
+
+def categoria_error(exc):
+    """Categoría corta de la excepción de una consulta, para contar las fallas por tipo."""
+    if isinstance(exc, CircuitoAbiertoError):
+        return "circuito_abierto"
+    if isinstance(exc, (requests.exceptions.Timeout, urllib3.exceptions.ReadTimeoutError)):
+        return "tiempo_agotado"
+    if isinstance(exc, (requests.exceptions.ConnectionError,) + ERRORES_CORTE_RESPUESTA):
+        return "conexion"
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        if exc.response.status_code == 429:
+            return "http_429"
+        return "http_5xx" if exc.response.status_code >= 500 else "http_4xx"
+    if isinstance(exc, requests.exceptions.JSONDecodeError):
+        return "json_invalido"
+    if isinstance(exc, ET.ParseError):
+        return "xml_invalido"
+    return "otro"
+
+
+def configurar_bitacora(nivel=None):
+    """Envía la bitácora 'cenacepml' a stderr; el nivel sale de PML_LOG_LEVEL (INFO por omisión)."""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(nivel or os.environ.get("PML_LOG_LEVEL", "INFO"))
+
+
+def medir(metrics, etapa):
+    """metrics.medir(etapa), o un contexto vacío si no hay métricas."""
+    return metrics.medir(etapa) if metrics is not None else nullcontext()
+
+
+class PMLMetrics:
+    """Tiempos por etapa, contadores y errores por nodo de una consulta; seguro entre hilos.
+
+    Las etapas que corren en los hilos de consulta (http, decodificación) suman el tiempo de
+    todos los hilos, así que pueden superar el tiempo real transcurrido.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.inicio = time.perf_counter()
+        self.etapas = {}  # etapa -> [segundos, llamadas]
+        self.contadores = {}
+        self.errores = []  # (clv_nodo, fecha_inicio, fecha_fin, categoria, error)
+
+    @contextmanager
+    def medir(self, etapa):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.agregar_tiempo(etapa, time.perf_counter() - inicio)
+
+    def agregar_tiempo(self, etapa, segundos):
+        with self._lock:
+            acumulado = self.etapas.setdefault(etapa, [0.0, 0])
+            acumulado[0] += segundos
+            acumulado[1] += 1
+
+    def contar(self, nombre, cantidad=1):
+        with self._lock:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + cantidad
+
+    def registrar_error(self, consulta, exc):
+        lote, inicio, fin = consulta
+        categoria = categoria_error(exc)
+        error = f"{type(exc).__name__}: {exc}"
+        with self._lock:
+            self.errores.extend((nodo, inicio, fin, categoria, error) for nodo in lote)
+        logger.warning("Consulta fallida (%s) %s a %s, %d nodo(s): %s", categoria, inicio, fin, len(lote), error)
+
+    def tiempos(self):
+        """DataFrame etapa, segundos, llamadas, de la etapa más lenta a la más rápida."""
+        with self._lock:
+            filas = [(etapa, segundos, llamadas) for etapa, (segundos, llamadas) in self.etapas.items()]
+        return pd.DataFrame(filas, columns=['etapa', 'segundos', 'llamadas']).sort_values('segundos', ascending=False, ignore_index=True)
+
+    def errores_df(self):
+        with self._lock:
+            return pd.DataFrame(self.errores, columns=['clv_nodo', 'fecha_inicio', 'fecha_fin', 'categoria', 'error'])
+
+    def to_dict(self):
+        errores = self.errores_df()
+        with self._lock:
+            return {
+                "duracion_s": round(time.perf_counter() - self.inicio, 3),
+                "etapas": {etapa: {"segundos": round(segundos, 4), "llamadas": llamadas}
+                           for etapa, (segundos, llamadas) in self.etapas.items()},
+                "contadores": dict(self.contadores),
+                "nodos_con_error": int(errores['clv_nodo'].nunique()),
+                "errores_por_categoria": errores.groupby('categoria')['clv_nodo'].nunique().to_dict(),
+            }
+
+    def log(self, **contexto):
+        """Una línea JSON en la bitácora con el contexto de la consulta y todas las métricas."""
+        logger.info(json.dumps({"evento": "consulta_pml", **contexto, **self.to_dict()}, ensure_ascii=False, default=str))
+
+
+def build_fecha_hora(fecha, hora):
+    """Convierte fecha ('%Y-%m-%d') y hora (1-24) del CENACE en un timestamp.
+
+    Se calcula como fecha + hora * 1h, así la hora 24 queda en las 00:00 del día siguiente.
+    Las fechas inválidas quedan como NaT.
+    """
+    fechas = pd.to_datetime(fecha, format="%Y-%m-%d", errors="coerce")
+    horas = pd.to_numeric(hora, errors="coerce").fillna(0)
+    return fechas + pd.to_timedelta(horas, unit="h")
+
+
+def fecha_hora_original(fecha_hora):
+    """Inverso de build_fecha_hora: regresa (fecha '%Y-%m-%d', hora 1-24) como los entrega el CENACE."""
+    anterior = fecha_hora - pd.Timedelta(hours=1)
+    return anterior.dt.strftime("%Y-%m-%d"), anterior.dt.hour + 1
+
+
+def downsample_min_max(df, x_col, y_col, max_puntos=MAX_PUNTOS_GRAFICA, group_cols=None):
+    """Reduce cada serie a max_puntos conservando el mínimo y el máximo de cada intervalo.
+
+    Se conservan todas las columnas de las filas elegidas, así los tooltips siguen funcionando.
+    """
+    if len(df) <= max_puntos:
+        return df
+
+    df = df.sort_values(x_col)
+    if group_cols:
+        posicion = df.groupby(group_cols, sort=False, observed=True).cumcount().to_numpy()
+        tamano = df.groupby(group_cols, sort=False, observed=True)[x_col].transform('size').to_numpy()
+        claves = [df[col] for col in group_cols]
+    else:
+        posicion = np.arange(len(df))
+        tamano = np.full(len(df), len(df))
+        claves = []
+
+    # Cada intervalo aporta dos filas (mínimo y máximo), por eso max_puntos // 2 intervalos
+    num_intervalos = max(1, max_puntos // 2)
+    intervalo = pd.Series(posicion * num_intervalos // tamano, index=df.index)
+    agrupado = df[y_col].groupby(claves + [intervalo], observed=True)
+    filas = np.union1d(agrupado.idxmin().dropna().to_numpy(), agrupado.idxmax().dropna().to_numpy())
+    return df.loc[filas].sort_values(x_col)
+
+
+def export_frame(df, formato, filas_por_bloque=FILAS_POR_BLOQUE_EXPORTACION):
+    """Serializa df en uno de FORMATOS_EXPORTACION y regresa los bytes del archivo.
+
+    Se escribe por bloques de filas directamente al archivo comprimido, así nunca existe
+    una copia completa del CSV como texto en memoria.
+    """
+    buffer = pa.BufferOutputStream()
+    esquema = pa.Schema.from_pandas(df, preserve_index=False)
+    if formato == "Parquet":
+        writer = pq.ParquetWriter(buffer, esquema, compression="zstd")
+        sink = None
+    else:
+        # El CSV no admite columnas de diccionario (categóricas): se escriben como texto
+        esquema = pa.schema([
+            campo.with_type(campo.type.value_type) if pa.types.is_dictionary(campo.type) else campo
+            for campo in esquema
+        ])
+        if formato == "CSV (gzip)":
+            # gzip de la biblioteca estándar con nivel 6: el de pyarrow usa el nivel 9, mucho más lento
+            sink = gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6)
+        else:
+            sink = pa.CompressedOutputStream(buffer, "zstd")
+        writer = pa_csv.CSVWriter(sink, esquema)
+
+    for inicio in range(0, len(df), filas_por_bloque):
+        bloque = pa.Table.from_pandas(df.iloc[inicio:inicio + filas_por_bloque], preserve_index=False)
+        writer.write_table(bloque.cast(esquema))
+    writer.close()
+    if sink is not None:
+        sink.close()
+    return buffer.getvalue().to_pybytes()
+
+
+def tamano_en_bytes(valor, _vistos=None):
+    """Memoria aproximada de valor: DataFrames con memory_usage(deep=True), contenedores y atributos recursivamente."""
+    vistos = set() if _vistos is None else _vistos
+    if id(valor) in vistos:
+        return 0
+    vistos.add(id(valor))
+    if isinstance(valor, pd.DataFrame):
+        return int(valor.memory_usage(deep=True).sum())
+    if isinstance(valor, (pd.Series, pd.Index)):
+        return int(valor.memory_usage(deep=True))
+    if isinstance(valor, dict):
+        return sys.getsizeof(valor) + sum(tamano_en_bytes(k, vistos) + tamano_en_bytes(v, vistos) for k, v in valor.items())
+    if isinstance(valor, (list, tuple, set)):
+        return sys.getsizeof(valor) + sum(tamano_en_bytes(v, vistos) for v in valor)
+    # El Styler de pandas y las gráficas de Altair guardan su tabla en .data
+    datos = getattr(valor, "data", None)
+    if isinstance(datos, pd.DataFrame):
+        return sys.getsizeof(valor) + tamano_en_bytes(datos, vistos)
+    if hasattr(valor, "__dict__"):
+        return sys.getsizeof(valor) + tamano_en_bytes(vars(valor), vistos)
+    return sys.getsizeof(valor)
+
+
+_SIN_VALOR = object()
+
+
+class VistasCache:
+    """Caché en memoria, LRU y con vigencia, para resultados derivados de consultas PML.
+
+    El tamaño de cada entrada se estima con tamano_en_bytes: al rebasar max_bytes se descartan
+    las entradas usadas hace más tiempo, y ninguna dura más de ttl segundos. Es seguro entre
+    hilos, así que las sesiones de Streamlit pueden compartir una instancia.
+    """
+
+    def __init__(self, max_bytes=int(CACHE_VISTAS_MB * 2**20), ttl=CACHE_VISTAS_TTL):
+        self.max_bytes = max_bytes
+        self._cache = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=tamano_en_bytes)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave, default=None):
+        with self._lock:
+            valor = self._cache.get(clave, _SIN_VALOR)
+            if valor is _SIN_VALOR:
+                self.fallos += 1
+                return default
+            self.aciertos += 1
+            return valor
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            try:
+                self._cache[clave] = valor
+            except ValueError:
+                # Más grande que todo el presupuesto: se usa sin guardarse
+                logger.info("Vista de %s MB fuera del caché (presupuesto %s MB)",
+                            round(tamano_en_bytes(valor) / 2**20, 1), round(self.max_bytes / 2**20, 1))
+
+    def obtener(self, clave, calcular):
+        """Valor guardado en clave; si falta o ya venció, se calcula con calcular() y se guarda."""
+        valor = self.get(clave, _SIN_VALOR)
+        if valor is _SIN_VALOR:
+            valor = calcular()
+            self.guardar(clave, valor)
+        return valor
+
+    def estado(self):
+        with self._lock:
+            return {'entradas': len(self._cache), 'mb': self._cache.currsize / 2**20, 'mb_max': self.max_bytes / 2**20,
+                    'aciertos': self.aciertos, 'fallos': self.fallos}
+
+
+class CircuitoAbiertoError(RuntimeError):
+    """El servicio del CENACE falló demasiadas veces seguidas; no se consulta hasta que pase la espera."""
+
+
+class CenaceScheduler:
+    """Planificador de consultas al CENACE compartido por todas las sesiones del proceso.
+
+    - Deduplica consultas en curso: los nodos cuyos días ya está descargando otra sesión se toman
+      de ese resultado en lugar de pedirse otra vez.
+    - Limita las consultas simultáneas (un solo pool) y las solicitudes HTTP por segundo, incluidos
+      los reintentos.
+    - Abre un circuito tras umbral_fallas consultas seguidas con errores transitorios: durante
+      espera_circuito segundos se falla de inmediato y después se deja pasar una consulta de prueba.
+    """
+
+    def __init__(self, max_concurrentes=MAX_CONSULTAS_GLOBALES, solicitudes_por_segundo=SOLICITUDES_POR_SEGUNDO,
+                 umbral_fallas=UMBRAL_FALLAS_CIRCUITO, espera_circuito=ESPERA_CIRCUITO):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(max_concurrentes)), thread_name_prefix="cenace")
+        self.solicitudes_por_segundo = float(solicitudes_por_segundo)
+        self.umbral_fallas = umbral_fallas
+        self.espera_circuito = espera_circuito
+        # RLock: un add_done_callback sobre un Future ya terminado corre de inmediato con el lock tomado
+        self._lock = threading.RLock()
+        self._en_curso = {}  # (sistema, proceso, clv_nodo, fecha) -> Future con el DataFrame de la consulta
+        self._fichas = self.solicitudes_por_segundo
+        self._ultima_recarga = time.monotonic()
+        self._fallas_seguidas = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+        self.consultas = 0
+        self.consultas_compartidas = 0
+
+    def fetch(self, fetcher, sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato="JSON"):
+        """Regresa el DataFrame procesado de la consulta, reutilizando lo que ya está en curso."""
+        fechas = _fechas_entre(fecha_inicio, fecha_fin)
+        nuevos = []
+        compartidos = {}  # Future de otra consulta -> (nodo, fecha) de esta consulta que cubre
+        with self._lock:
+            for nodo in lista_nodos:
+                cubiertos = [self._en_curso.get((sistema, proceso, nodo, fecha)) for fecha in fechas]
+                if None in cubiertos:
+                    nuevos.append(nodo)
+                else:
+                    # Cada día se toma de una sola consulta, aunque varias en curso lo incluyan
+                    for fecha, future in zip(fechas, cubiertos):
+                        compartidos.setdefault(future, set()).add((nodo, fecha))
+
+            propio = None
+            if nuevos:
+                if self.circuito_abierto():
+                    raise CircuitoAbiertoError(self._mensaje_circuito())
+                propio = self.executor.submit(self._consultar, fetcher, sistema, proceso, nuevos, fecha_inicio, fecha_fin, formato)
+                claves = [(sistema, proceso, nodo, fecha) for nodo in nuevos for fecha in fechas]
+                self._en_curso.update(dict.fromkeys(claves, propio))
+                propio.add_done_callback(partial(self._liberar, claves))
+                self.consultas += 1
+            self.consultas_compartidas += len(compartidos)
+
+        partes = [propio.result()] if propio is not None else []
+        for future, nodo_dias in compartidos.items():
+            fetcher.metrics.contar("consultas_compartidas")
+            with fetcher.metrics.medir("espera_consulta_compartida"):
+                pml_data = future.result()
+            cubiertas = pd.MultiIndex.from_arrays([pml_data['clv_nodo'], pml_data['fecha']]).isin(list(nodo_dias))
+            partes.append(pml_data[cubiertas])
+        if len(partes) == 1:
+            return partes[0]
+        return pd.concat(partes, ignore_index=True)
+
+    def _consultar(self, fetcher, sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato):
+        # Se revisa otra vez al salir de la cola: el circuito pudo abrirse mientras esperaba
+        self._permitir_consulta()
+        try:
+            raw_data = fetcher.request_pml_data(sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato)
+        except Exception as e:
+            self._registrar_resultado(exito=not es_error_transitorio(e))
+            raise
+        self._registrar_resultado(exito=True)
+
+        with fetcher.metrics.medir("parseo"):
+            pml_data = fetcher.process_response(raw_data)
+        fetcher.metrics.contar("filas_parseadas", len(pml_data))
+        if fetcher.store is not None:
+            with fetcher.metrics.medir("almacen_guardar"):
+                fetcher.store.save(sistema, proceso, pml_data)
+        return pml_data
+
+    def _liberar(self, claves, future):
+        with self._lock:
+            for clave in claves:
+                if self._en_curso.get(clave) is future:
+                    del self._en_curso[clave]
+
+    def esperar_turno(self):
+        """Bloquea hasta que el límite global de solicitudes por segundo permite una más (cubeta de fichas)."""
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.solicitudes_por_segundo,
+                                   self._fichas + (ahora - self._ultima_recarga) * self.solicitudes_por_segundo)
+                self._ultima_recarga = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                espera = (1 - self._fichas) / self.solicitudes_por_segundo
+            time.sleep(espera)
+
+    def circuito_abierto(self):
+        with self._lock:
+            return self._fallas_seguidas >= self.umbral_fallas and (
+                time.monotonic() < self._abierto_hasta or self._prueba_en_curso)
+
+    def _permitir_consulta(self):
+        with self._lock:
+            if self._fallas_seguidas < self.umbral_fallas:
+                return
+            if time.monotonic() < self._abierto_hasta or self._prueba_en_curso:
+                raise CircuitoAbiertoError(self._mensaje_circuito())
+            # Medio abierto: esta consulta es la prueba; su resultado cierra o vuelve a abrir el circuito
+            self._prueba_en_curso = True
+
+    def _registrar_resultado(self, exito):
+        with self._lock:
+            self._prueba_en_curso = False
+            if exito:
+                if self._fallas_seguidas >= self.umbral_fallas:
+                    logger.info("Circuito cerrado: el servicio del CENACE volvió a responder")
+                self._fallas_seguidas = 0
+                return
+            self._fallas_seguidas += 1
+            if self._fallas_seguidas >= self.umbral_fallas:
+                self._abierto_hasta = time.monotonic() + self.espera_circuito
+                logger.warning("Circuito abierto por %d consultas fallidas seguidas; se reintenta en %d s",
+                               self._fallas_seguidas, self.espera_circuito)
+
+    def _mensaje_circuito(self):
+        restante = max(0, self._abierto_hasta - time.monotonic())
+        return (f"Se suspendieron las consultas al CENACE tras {self._fallas_seguidas} fallas seguidas; "
+                f"se reintenta en {restante:.0f} s")
+
+    def estado(self):
+        with self._lock:
+            return {
+                "consultas": self.consultas,
+                "consultas_compartidas": self.consultas_compartidas,
+                "nodos_dia_en_curso": len(self._en_curso),
+                "circuito_abierto": self.circuito_abierto(),
+                "fallas_seguidas": self._fallas_seguidas,
+            }
+
+
+def _fechas_entre(fecha_inicio, fecha_fin):
+    inicio = datetime.strptime(fecha_inicio, "%Y-%m-%d")
+    dias = (datetime.strptime(fecha_fin, "%Y-%m-%d") - inicio).days
+    return [(inicio + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(dias + 1)]
+
+
+# --- Funciones para obtener y procesar datos ---
+class CenacePMLFetcher:
+    def __init__(self, base_url="https://ws01.cenace.gob.mx:8082/SWPML/SIM/", max_workers=MAX_CONSULTAS_SIMULTANEAS, store=None,
+                 timeout=(TIMEOUT_CONEXION, TIMEOUT_LECTURA), max_retries=MAX_REINTENTOS, metrics=None, scheduler=None):
+        self.base_url = base_url
+        self.max_workers = max(1, int(max_workers))
+        self.store = store
+        self.timeout = timeout
+        self.max_retries = max(1, int(max_retries))
+        # Consultas que fallaron después de los reintentos: (lote_nodos, fecha_inicio, fecha_fin, error)
+        self.failed_requests = []
+        # Tiempos por etapa, bytes, filas y errores por nodo de todo lo que hace este fetcher
+        self.metrics = metrics if metrics is not None else PMLMetrics()
+        # Planificador compartido (CenaceScheduler) o None para consultar directamente
+        self.scheduler = scheduler
+
+        # Sesión con conexiones persistentes; el pool alcanza para todos los hilos de consulta
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch_pml_data(self, sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato="JSON"):
+        try:
+            return self.request_pml_data(sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato)
+        except Exception as e:
+            consulta = (tuple(lista_nodos), fecha_inicio, fecha_fin)
+            self.failed_requests.append(consulta + (f"{type(e).__name__}: {e}",))
+            self.metrics.registrar_error(consulta, e)
+            return None
+
+    def request_pml_data(self, sistema, proceso, lista_nodos, fecha_inicio, fecha_fin, formato="JSON"):
+        """Igual que fetch_pml_data, pero lanza la excepción en lugar de regresar None."""
+        start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d")
+        end_date = datetime.strptime(fecha_fin, "%Y-%m-%d")
+
+        anio_ini = start_date.year
+        mes_ini = f"{start_date.month:02d}"
+        dia_ini = f"{start_date.day:02d}"
+        anio_fin = end_date.year
+        mes_fin = f"{end_date.month:02d}"
+        dia_fin = f"{end_date.day:02d}"
+
+        nodos_url_param = "-".join(lista_nodos)
+
+        url = (
+            f"{self.base_url}{sistema}/{proceso}/{nodos_url_param}/"
+            f"{anio_ini}/{mes_ini}/{dia_ini}/"
+            f"{anio_fin}/{mes_fin}/{dia_fin}/{formato}"
+        )
+
+        self.metrics.contar("consultas")
+        if formato.upper() == "JSON":
+            with self.metrics.medir("http"):
+                response = self._get(url)
+            self.metrics.contar("bytes_descargados", len(response.content))
+            with self.metrics.medir("decodificacion_json"):
+                return response.json()
+        elif formato.upper() == "XML":
+            # El XML se procesa mientras se descarga y se regresa ya como DataFrame; la lectura va
+            # dentro de los reintentos, así que un corte a media respuesta vuelve a pedir la consulta
+            with self.metrics.medir("http_y_parseo_xml"):
+                return self._get(url, leer=self._leer_xml)
+        else:
+            raise ValueError(f"Formato no soportado: {formato}")
+
+    def _get(self, url, leer=None):
+        """Respuesta de url; con leer, se pide en streaming y se regresa leer(response), reintentando también la lectura."""
+        # Reintentos con espera exponencial solo para errores transitorios
+        for attempt in Retrying(stop=stop_after_attempt(self.max_retries),
+                                wait=wait_exponential(multiplier=1, max=30),
+                                retry=retry_if_exception(es_error_transitorio),
+                                before_sleep=lambda estado: self.metrics.contar("reintentos"),
+                                reraise=True):
+            with attempt:
+                if self.scheduler is not None:
+                    with self.metrics.medir("espera_limite_global"):
+                        self.scheduler.esperar_turno()
+                response = self.session.get(url, timeout=self.timeout, stream=leer is not None)
+                try:
+                    response.raise_for_status()
+                    resultado = response if leer is None else leer(response)
+                except BaseException:
+                    # Un intento fallido no retiene su conexión del pool hasta la recolección de basura
+                    response.close()
+                    raise
+        return resultado
+
+    def _leer_xml(self, response):
+        try:
+            response.raw.decode_content = True
+            return self.process_xml_response(response.raw)
+        finally:
+            self.metrics.contar("bytes_descargados", response.raw.tell())
+            response.close()
+
+    def plan_requests(self, nodos, fecha_inicio, fecha_fin, max_nodos=MAX_NODOS_POR_CONSULTA, max_dias=MAX_DIAS_POR_CONSULTA):
+        """Agrupa nodos y fechas en el menor número de consultas que acepta el servicio.
+
+        Regresa una lista de tuplas (lote_nodos, fecha_inicio, fecha_fin) con fechas "%Y-%m-%d".
+        """
+        start_date = datetime.strptime(fecha_inicio, "%Y-%m-%d")
+        end_date = datetime.strptime(fecha_fin, "%Y-%m-%d")
+        if start_date > end_date:
+            return []
+
+        # Quitar nodos repetidos conservando el orden
+        nodos_unicos = list(dict.fromkeys(nodos))
+        lotes_nodos = [nodos_unicos[i:i + max_nodos] for i in range(0, len(nodos_unicos), max_nodos)]
+
+        ventanas = []
+        ventana_inicio = start_date
+        while ventana_inicio <= end_date:
+            ventana_fin = min(ventana_inicio + timedelta(days=max_dias - 1), end_date)
+            ventanas.append((ventana_inicio.strftime("%Y-%m-%d"), ventana_fin.strftime("%Y-%m-%d")))
+            ventana_inicio = ventana_fin + timedelta(days=1)
+
+        return [(lote, inicio, fin) for lote in lotes_nodos for inicio, fin in ventanas]
+
+    def plan_missing_requests(self, sistema, proceso, nodos, fecha_inicio, fecha_fin):
+        """Como plan_requests, pero solo para los nodos-día que no están en el almacén local."""
+        if self.store is None:
+            return self.plan_requests(nodos, fecha_inicio, fecha_fin)
+
+        # Agrupar los nodos que comparten el mismo tramo continuo de días faltantes
+        tramos = {}
+        for nodo, dias in self.store.missing_node_days(sistema, proceso, nodos, fecha_inicio, fecha_fin).items():
+            tramo_inicio = dias[0]
+            for anterior, dia in zip(dias, dias[1:] + [None]):
+                if dia is None or dia - anterior != timedelta(days=1):
+                    tramos.setdefault((tramo_inicio, anterior), []).append(nodo)
+                    tramo_inicio = dia
+
+        consultas = []
+        for (inicio, fin), nodos_tramo in sorted(tramos.items()):
+            consultas.extend(self.plan_requests(nodos_tramo, inicio.strftime("%Y-%m-%d"), fin.strftime("%Y-%m-%d")))
+        return consultas
+
+    def fetch_pml_data_concurrent(self, sistema, proceso, consultas, formato="JSON", max_workers=None):
+        """Ejecuta en paralelo las consultas de plan_requests y entrega (consulta, datos_crudos) conforme terminan.
+
+        Las consultas que fallan se entregan con datos None y se registran en failed_requests.
+        """
+        max_workers = max(1, int(max_workers or self.max_workers))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Con planificador, cada tarea espera el DataFrame ya procesado que entrega el planificador
+        consultar = self.request_pml_data if self.scheduler is None else partial(self.scheduler.fetch, self)
+        futures = {
+            executor.submit(consultar, sistema, proceso, lote, inicio, fin, formato): (lote, inicio, fin)
+            for lote, inicio, fin in consultas
+        }
+        try:
+            for future in as_completed(futures):
+                consulta = futures[future]
+                try:
+                    raw_data = future.result()
+                except Exception as e:
+                    self.failed_requests.append(consulta + (f"{type(e).__name__}: {e}",))
+                    self.metrics.registrar_error(consulta, e)
+                    raw_data = None
+                yield consulta, raw_data
+        finally:
+            # Si el consumidor abandona el generador (p. ej. al cancelar), no lanzar las consultas
+            # pendientes ni esperar a las que están en curso; sus respuestas se descartan
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def fetch_pml_rows(self, sistema, proceso, consultas, formato="JSON", max_workers=None):
+        """Ejecuta las consultas, procesa cada respuesta y la guarda en el almacén local si existe."""
+        for consulta, raw_data in self.fetch_pml_data_concurrent(sistema, proceso, consultas, formato, max_workers):
+            if self.scheduler is not None:
+                # El planificador ya procesó y guardó la respuesta, una sola vez para todas las sesiones
+                yield consulta, self.process_response(raw_data)
+                continue
+            with self.metrics.medir("parseo"):
+                pml_data = self.process_response(raw_data)
+            self.metrics.contar("filas_parseadas", len(pml_data))
+            if self.store is not None:
+                with self.metrics.medir("almacen_guardar"):
+                    self.store.save(sistema, proceso, pml_data)
+            yield consulta, pml_data
+
+    def iter_pml_frames(self, sistema, proceso, nodos, fecha_inicio, fecha_fin, consultas, formato="JSON",
+                        max_workers=None, nodos_por_lectura=200):
+        """Entrega (consulta, DataFrame): primero lo guardado en el almacén (consulta None) y luego cada descarga.
+
+        Cada nodo-día aparece una sola vez: del almacén solo se leen los nodos-día completos y
+        las consultas de plan_missing_requests cubren exactamente los faltantes.
+        """
+        if self.store is not None:
+            nodos = list(dict.fromkeys(nodos))
+            for i in range(0, len(nodos), nodos_por_lectura):
+                with self.metrics.medir("almacen_leer"):
+                    pml_data = self.store.load(sistema, proceso, nodos[i:i + nodos_por_lectura], fecha_inicio, fecha_fin,
+                                               solo_completos=True)
+                self.metrics.contar("filas_almacen", len(pml_data))
+                yield None, pml_data
+        yield from self.fetch_pml_rows(sistema, proceso, consultas, formato, max_workers)
+
+    def process_response(self, raw_data):
+        if raw_data is None:
+            return PMLColumnBuilder().to_frame()
+        if isinstance(raw_data, pd.DataFrame):
+            return raw_data
+        if isinstance(raw_data, dict) or isinstance(raw_data, list):
+            return self.process_json_response(raw_data)
+        elif ET.iselement(raw_data):
+            return self.process_xml_response(raw_data)
+        return PMLColumnBuilder().to_frame()
+
+    def process_json_response(self, json_data):
+        """Regresa un DataFrame con las columnas de PML_COLUMNAS."""
+        results = PMLColumnBuilder()
+        reports_to_process = []
+
+        if isinstance(json_data, dict):
+            if "Reporte" in json_data:
+                if isinstance(json_data["Reporte"], list):
+                    reports_to_process = json_data["Reporte"]
+                else:
+                    reports_to_process = [json_data["Reporte"]]
+            elif "nombre" in json_data and "Resultados" in json_data:
+                reports_to_process = [json_data]
+            else:
+                return results.to_frame()
+        elif isinstance(json_data, list):
+            reports_to_process = json_data
+        else:
+            return results.to_frame()
+
+        for report_item in reports_to_process:
+            if not isinstance(report_item, dict):
+                continue
+
+            try:
+                resultados_content = report_item.get("Resultados")
+                all_nodes_from_report = []
+
+                if isinstance(resultados_content, dict):
+                    node_data_from_dict = resultados_content.get("Nodo")
+                    if isinstance(node_data_from_dict, list):
+                        all_nodes_from_report.extend(node_data_from_dict)
+                    elif isinstance(node_data_from_dict, dict):
+                        all_nodes_from_report.append(node_data_from_dict)
+                elif isinstance(resultados_content, list):
+                    all_nodes_from_report.extend(resultados_content)
+                else:
+                    continue
+
+                for nodo_data in all_nodes_from_report:
+                    if not isinstance(nodo_data, dict):
+                        continue
+
+                    clv_nodo = nodo_data.get("clv_nodo")
+                    if clv_nodo:
+                        valores_data = nodo_data.get("Valores")
+
+                        if isinstance(valores_data, list):
+                            for valor_item in valores_data:
+                                if not isinstance(valor_item, dict):
+                                    continue
+                                fecha = valor_item.get("fecha")
+                                if fecha is None:
+                                    continue
+                                try:
+                                    # Convertir todos los campos antes de agregar para no dejar columnas desalineadas
+                                    hora = int(valor_item.get("hora"))
+                                    pml = float(valor_item.get("pml"))
+                                    pml_ene = float(valor_item.get("pml_ene"))
+                                    pml_per = float(valor_item.get("pml_per"))
+                                    pml_cng = float(valor_item.get("pml_cng"))
+                                except (ValueError, TypeError):
+                                    continue
+                                results.append(clv_nodo, fecha, hora, pml, pml_ene, pml_per, pml_cng)
+                        else:
+                            pass
+                    else:
+                        pass
+            except Exception:
+                pass
+        return results.to_frame()
+
+
+    def process_xml_response(self, xml_source):
+        """Regresa un DataFrame con las columnas de PML_COLUMNAS.
+
+        xml_source puede ser un Element ya construido o un archivo/flujo de bytes; en este
+        último caso el documento se procesa con iterparse sin construir el árbol completo.
+        """
+        results = PMLColumnBuilder()
+        if xml_source is None:
+            return results.to_frame()
+
+        streaming = not ET.iselement(xml_source)
+        if streaming:
+            eventos = ET.iterparse(xml_source, events=("end",))
+            elementos = (elem for _, elem in eventos)
+        else:
+            if xml_source.tag != "Reporte":
+                return results.to_frame()
+            elementos = xml_source.iter()
+
+        # Una sola pasada: cada Valor se lee leyendo sus hijos directos una vez
+        clv_nodo = None
+        for elem in elementos:
+            tag = elem.tag
+            if tag == "Valor":
+                if clv_nodo:
+                    campos = {hijo.tag: hijo.text for hijo in elem}
+                    try:
+                        if campos["fecha"] is not None:
+                            results.append(clv_nodo, campos["fecha"], int(campos["hora"]), float(campos["pml"]),
+                                           float(campos["pml_ene"]), float(campos["pml_per"]), float(campos["pml_cng"]))
+                    except (KeyError, ValueError, TypeError):
+                        pass
+                if streaming:
+                    elem.clear()
+            elif tag == "clv_nodo":
+                clv_nodo = elem.text
+            elif tag == "Nodo":
+                clv_nodo = None
+                if streaming:
+                    # Liberar el nodo completo una vez procesado
+                    elem.clear()
+
+        if streaming and eventos.root.tag != "Reporte":
+            return PMLColumnBuilder().to_frame()
+        return results.to_frame()
+
+
+# --- Catálogo de nodos (acepta rutas de string u objetos de archivo con atributo name) ---
+CATALOGO_EXTENSIONES = ('.csv', '.xlsx')
+
+
+def read_nodos_catalogo(file_source):
+    try:
+        if isinstance(file_source, str): # Si es una ruta de archivo (string)
+            file_extension = os.path.splitext(file_source)[1].lower()
+        else: # Si es un objeto de archivo (p. ej. UploadedFile de Streamlit)
+            file_extension = os.path.splitext(file_source.name)[1].lower()
+
+        if file_extension == '.csv':
+            df = pd.read_csv(file_source)
+        elif file_extension == '.xlsx':
+            df = pd.read_excel(file_source)
+        else:
+            return pd.DataFrame()
+
+        original_columns = df.columns.tolist()
+        cleaned_columns = [col.strip().replace(' ', '_').replace('(', '').replace(')', '') for col in original_columns]
+        df.columns = cleaned_columns
+
+        rename_map = {
+            'CLAVE': 'CLAVE_NODO_P',
+            'ENTIDAD_FEDERATIVA_INEGI': 'ESTADO',
+            'MUNICIPIO_INEGI': 'MUNICIPIO',
+            'SISTEMA': 'SISTEMA'
+        }
+
+        df = df.rename(columns={k: v for k, v in rename_map.items() if k in df.columns})
+
+        required_columns_after_rename = ['CLAVE_NODO_P', 'ESTADO', 'MUNICIPIO', 'SISTEMA']
+        for col in required_columns_after_rename:
+            if col not in df.columns:
+                return pd.DataFrame()
+        return df
+    except FileNotFoundError:
+        return pd.DataFrame()
+    except Exception:
+        return pd.DataFrame()
+
+
+class NodosIndex:
+    """Índice jerárquico del catálogo: estado -> municipio -> claves de nodo ordenadas.
+
+    Se construye una sola vez por catálogo; los selectores solo hacen búsquedas en diccionarios.
+    """
+
+    def __init__(self, nodos_df):
+        columnas = ['CLAVE_NODO_P', 'ESTADO', 'MUNICIPIO', 'SISTEMA']
+        if nodos_df.empty or any(col not in nodos_df.columns for col in columnas):
+            nodos_df = pd.DataFrame(columns=columnas)
+        # Solo se descartan filas sin clave: un nodo sin ESTADO o MUNICIPIO sigue en "Todos los Nodos"
+        self.df = nodos_df.dropna(subset=['CLAVE_NODO_P']).drop_duplicates('CLAVE_NODO_P').astype({col: 'category' for col in columnas})
+
+        claves = self.df['CLAVE_NODO_P'].astype(str)
+        con_sistema = self.df['SISTEMA'].notna()
+        con_estado = self.df['ESTADO'].notna()
+        con_municipio = con_estado & self.df['MUNICIPIO'].notna()
+
+        self.todos_los_nodos = sorted(claves)
+        self.sistemas = sorted(self.df['SISTEMA'].dropna().astype(str).unique())
+        self.sistema_por_nodo = dict(zip(claves[con_sistema], self.df['SISTEMA'][con_sistema].astype(str)))
+        self.estados = sorted(self.df['ESTADO'].dropna().astype(str).unique())
+
+        # Las listas por estado y por municipio solo llevan los nodos que tienen esa ubicación
+        self.nodos_por_estado = {
+            estado: sorted(grupo)
+            for estado, grupo in claves[con_estado].groupby(self.df['ESTADO'][con_estado].astype(str))
+        }
+        self.municipios_por_estado = {}
+        self.nodos_por_municipio = {}
+        estados = self.df['ESTADO'][con_municipio].astype(str)
+        municipios = self.df['MUNICIPIO'][con_municipio].astype(str)
+        for (estado, municipio), grupo in claves[con_municipio].groupby([estados, municipios]):
+            self.municipios_por_estado.setdefault(estado, []).append(municipio)
+            self.nodos_por_municipio[(estado, municipio)] = sorted(grupo)
+        for estado in self.municipios_por_estado:
+            self.municipios_por_estado[estado].sort()
+
+        # Tablas de códigos para compact_frame: posición de la clave en sus categorías -> código
+        # de estado/municipio; la última posición (-1) corresponde a claves fuera del catálogo
+        self.clave_dtype = self.df['CLAVE_NODO_P'].dtype
+        self.estado_dtype = self.df['ESTADO'].dtype
+        self.municipio_dtype = self.df['MUNICIPIO'].dtype
+        fila_por_clave = pd.Index(claves).get_indexer(self.clave_dtype.categories.astype(str))
+        self._estado_por_clave = np.append(self.df['ESTADO'].cat.codes.to_numpy()[fila_por_clave], -1)
+        self._municipio_por_clave = np.append(self.df['MUNICIPIO'].cat.codes.to_numpy()[fila_por_clave], -1)
+
+    @property
+    def empty(self):
+        return self.df.empty
+
+    def compact_frame(self, pml_df, metrics=None):
+        """Convierte un DataFrame de PML_COLUMNAS a la forma compacta que usa la aplicación.
+
+        Columnas: clv_nodo, ESTADO y MUNICIPIO categóricas, un solo timestamp fecha_hora y
+        los componentes del precio en float32. Se descartan las filas sin fecha_hora o sin pml.
+        ESTADO y MUNICIPIO salen de los códigos del catálogo, sin merge; un nodo fuera del
+        catálogo conserva su clave (como categoría adicional) con ESTADO y MUNICIPIO vacíos.
+        Con metrics se miden por separado la corrección de fecha/hora y la unión con el catálogo.
+        """
+        with medir(metrics, "correccion_fecha_hora"):
+            fecha_hora = build_fecha_hora(pml_df['fecha'], pml_df['hora'])
+            validas = (fecha_hora.notna() & pml_df['pml'].notna()).to_numpy()
+
+        with medir(metrics, "union_catalogo"):
+            claves_api = pml_df['clv_nodo'].to_numpy()[validas]
+            categorias = self.clave_dtype.categories
+            # -1 en claves fuera del catálogo: en las tablas de códigos es la posición sin estado/municipio
+            codigos = categorias.get_indexer(claves_api)
+            fuera = codigos == -1
+            if fuera.any():
+                claves = pd.Categorical(claves_api, categories=categorias.append(pd.Index(pd.unique(claves_api[fuera]))))
+            else:
+                claves = pd.Categorical.from_codes(codigos, dtype=self.clave_dtype)
+            return pd.DataFrame({
+                'clv_nodo': claves,
+                'ESTADO': pd.Categorical.from_codes(self._estado_por_clave[codigos], dtype=self.estado_dtype),
+                'MUNICIPIO': pd.Categorical.from_codes(self._municipio_por_clave[codigos], dtype=self.municipio_dtype),
+                'fecha_hora': fecha_hora.to_numpy()[validas],
+                'pml': pml_df['pml'].to_numpy()[validas].astype(np.float32),
+                'pml_ene': pml_df['pml_ene'].to_numpy()[validas].astype(np.float32),
+                'pml_per': pml_df['pml_per'].to_numpy()[validas].astype(np.float32),
+                'pml_cng': pml_df['pml_cng'].to_numpy()[validas].astype(np.float32),
+            })
+
+    def municipios(self, estado):
+        return self.municipios_por_estado.get(estado, [])
+
+    def nodos(self, estado=None, municipio=None, sistema=None):
+        """Claves de nodo de la ubicación; con sistema, solo las de ese sistema (y las que no lo tienen en el catálogo)."""
+        if estado is None:
+            nodos = self.todos_los_nodos
+        elif municipio is None:
+            nodos = self.nodos_por_estado.get(estado, [])
+        else:
+            nodos = self.nodos_por_municipio.get((estado, municipio), [])
+        if sistema is None:
+            return nodos
+        return [nodo for nodo in nodos if self.sistema_por_nodo.get(nodo, sistema) == sistema]
@@ -0,0 +1,180 @@
+"""Analysis helpers for Fluke analyzer recordings, free of Streamlit.
+
+Used by the viewer (graph_nrgy_monitor.py) and the benchmarks: CSV loading, rollup pyramids,
+LTTB downsampling, time-range slicing and power-quality statistics.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+from fluke_store import detect_timestamp_format
+
+# Roughly two points per horizontal pixel of a wide chart; more than this is not visible
+MAX_CHART_POINTS = 2000
+
+# Rollup pyramid levels, finest to coarsest; each stores min/mean/max per channel
+ROLLUP_LEVELS = ["1s", "1min", "15min", "1h"]
+
+# Samples further apart than this many median intervals are a logging gap: not integrated across
+MAX_GAP_INTERVALS = 5
+
+
+def read_fluke_csv(file_bytes):
+    """Fluke CSV export -> float32 frame indexed by the sorted Timestamp."""
+    df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow")
+
+    # Parse 'Timestamp' with one explicit format instead of per-row inference
+    if not pd.api.types.is_datetime64_any_dtype(df['Timestamp']):
+        timestamp_format = detect_timestamp_format(str(df['Timestamp'].iloc[0]))
+        df['Timestamp'] = pd.to_datetime(df['Timestamp'], format=timestamp_format)
+
+    # Measurements as float32: half the memory of float64 and enough precision for the analyzer
+    numeric_columns = df.select_dtypes(include='number').columns
+    df[numeric_columns] = df[numeric_columns].astype('float32')
+
+    return df.set_index('Timestamp').sort_index()
+
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: positions of the n_out points that best keep the shape of y(x)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    # n_out - 2 buckets between the first and last points, which are always kept
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    edges = np.append(edges, n)
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def build_rollup_pyramid(df):
+    """Resample the whole recording into {level: frame with (channel, min/mean/max) columns}."""
+    if len(df) < 2:
+        return {}
+    sample_interval = df.index[:10000].to_series().diff().median()
+
+    pyramid = {}
+    for rule in ROLLUP_LEVELS:
+        # A level no coarser than the sampling interval would just duplicate the raw data
+        if pd.Timedelta(rule) <= sample_interval:
+            continue
+        # Only numeric channels are rolled up; text columns (status flags) are drawn from the raw samples
+        pyramid[rule] = df.select_dtypes('number').resample(rule).agg(['min', 'mean', 'max']).dropna(how='all')
+    return pyramid
+
+
+def thin_rollup(level_df, max_points=MAX_CHART_POINTS):
+    # Merge runs of consecutive buckets so the chosen level fits the chart exactly
+    step = -(-len(level_df) // max_points)
+    if step <= 1:
+        return level_df
+    thinned = level_df.groupby(np.arange(len(level_df)) // step).agg({'min': 'min', 'mean': 'mean', 'max': 'max'})
+    thinned.index = level_df.index[::step]
+    return thinned
+
+
+def select_rollup_level(pyramid, channel, start, end, max_points=MAX_CHART_POINTS):
+    """Coarsest level that still has at least max_points buckets in [start, end], or None."""
+    for rule in reversed(ROLLUP_LEVELS):
+        if rule not in pyramid or channel not in pyramid[rule].columns.get_level_values(0):
+            continue
+        level = pyramid[rule]
+        window = level[channel].iloc[time_range_slice(level.index, start, end)]
+        if len(window) >= max_points:
+            return rule, thin_rollup(window, max_points)
+    return None
+
+
+def time_range_slice(index, start, end):
+    """Positional slice of the sorted index covering [start, end], found by binary search."""
+    return slice(index.searchsorted(start, side='left'), index.searchsorted(end, side='right'))
+
+
+def downsample_series(series, max_points=MAX_CHART_POINTS):
+    series = series.dropna()
+    if len(series) <= max_points:
+        return series
+    if not pd.api.types.is_numeric_dtype(series):
+        # LTTB needs numeric values; text columns are thinned evenly instead
+        return series.iloc[::-(-len(series) // max_points)]
+    positions = lttb_indices(series.index.asi8, series.to_numpy(), max_points)
+    return series.iloc[positions]
+
+
+def trailing_window_starts(t, window_ns):
+    """Position of the first sample inside [t - window, t] for every sample of the sorted times t."""
+    return np.searchsorted(t, t - window_ns, side='right')
+
+
+def rolling_mean(y, starts):
+    """Mean of y[starts[i]:i + 1] at every i, from cumulative sums; NaNs are skipped."""
+    valid = ~np.isnan(y)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, y, 0.0), dtype='float64')))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    ends = np.arange(1, len(y) + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[ends] - sums[starts]) / (counts[ends] - counts[starts])
+
+
+def power_quality_stats(frame, window, thresholds):
+    """One row per channel of frame: distribution, rolling-mean peak, time integral and threshold exceedances.
+
+    thresholds maps channel -> (lower, upper), either of which may be None.
+    """
+    t = frame.index.as_unit('ns').asi8
+    dt = np.diff(t)
+    max_gap = np.median(dt) * MAX_GAP_INTERVALS if len(dt) else 0
+    # Intervals across a logging gap count for neither the integral nor the time outside the limits
+    dt_hours = np.where(dt <= max_gap, dt, 0) / 3.6e12
+    window_ns = pd.Timedelta(window).value
+    # Shared by every channel; windows that start before the range are partial and would bias the peak
+    starts = trailing_window_starts(t, window_ns)
+    complete = t - t[0] >= window_ns if len(t) else np.zeros(0, dtype=bool)
+
+    rows = {}
+    for channel in frame.columns:
+        y = frame[channel].to_numpy(dtype='float64')
+        valid = y[~np.isnan(y)]
+        row = {'Samples': len(valid)}
+        if len(valid):
+            p95, p99 = np.percentile(valid, [95, 99])
+            row.update({'Min': valid.min(), 'Mean': valid.mean(), 'Max': valid.max(), 'P95': p95, 'P99': p99})
+        means = rolling_mean(y, starts)[complete]
+        means = means[~np.isnan(means)]
+        row[f'Max {window} mean'] = means.max() if len(means) else np.nan
+        # Trapezoids between consecutive valid samples; NaN neighbours drop out of the sum
+        row['Integral (unit·h)'] = np.nansum((y[1:] + y[:-1]) / 2 * dt_hours)
+
+        lower, upper = thresholds.get(channel, (None, None))
+        if lower is not None or upper is not None:
+            outside = np.zeros(len(y), dtype=bool)
+            if lower is not None:
+                outside |= y < lower
+            if upper is not None:
+                outside |= y > upper
+            row['Samples outside limits'] = int(outside.sum())
+            # An event is each entry into the out-of-limits state
+            row['Events'] = int(outside[:1].sum() + np.count_nonzero(outside[1:] & ~outside[:-1]))
+            row['Hours outside limits'] = dt_hours[outside[:-1]].sum()
+        rows[channel] = row
+    stats = pd.DataFrame.from_dict(rows, orient='index')
+    for column in ('Samples outside limits', 'Events'):
+        if column in stats:
+            stats[column] = stats[column].astype('Int64')
+    return stats
@@ -0,0 +1,322 @@
+"""Out-of-core storage for Fluke analyzer recordings.
+
+One or many CSV exports are converted block by block into a Parquet dataset partitioned by day,
+plus a 1-minute min/max/sum/count rollup. Reads push the time window and the channel selection
+down to the files, so only the requested column and range are ever loaded.
+
+    python fluke_store.py --name site_a_january exports/site_a_*.csv
+
+Importing again into the same recording appends new files; files already imported (same name
+and size) are skipped. The manifest is the commit point of an import: it lists the Parquet files
+and the rollup that make up the recording, and a failed or interrupted import removes its files.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import uuid
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+from pandas.tseries.api import guess_datetime_format
+
+# Recordings live in one subdirectory each; override with the FLUKE_STORE_DIR environment variable
+FLUKE_STORE_DIR = os.environ.get("FLUKE_STORE_DIR",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), "fluke_store"))
+
+# Server directory whose CSV files the web app may import by path; unset, only uploads are accepted
+FLUKE_IMPORT_DIR = os.environ.get("FLUKE_IMPORT_DIR")
+
+# Bytes of CSV parsed per block; bounds memory during ingestion regardless of file size
+CSV_BLOCK_SIZE = 16 << 20
+
+# Rows per Parquet row group: small enough that time filters skip most of a day's file
+ROWS_PER_GROUP = 64 * 1024
+
+# Bucket of the rollup stored alongside the samples
+STORE_ROLLUP_RULE = "1min"
+
+MANIFEST_NAME = "manifest.json"
+RECORDING_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# Timestamp layouts seen in Fluke exports that pandas does not guess on its own
+FLUKE_TIMESTAMP_FORMATS = [
+    "%m/%d/%Y %I:%M:%S %p",
+    "%m/%d/%Y %I:%M:%S.%f %p",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M:%S.%f",
+]
+
+# Cell contents read as a missing sample; overload and blank markers of the exports included
+FLUKE_NULL_VALUES = ["", "NA", "N/A", "NaN", "nan", "null", "-", "--", "---", "OL", "+OL", "-OL"]
+
+DATE_PARTITIONING = ds.partitioning(pa.schema([("date", pa.date32())]), flavor="hive")
+
+
+def detect_timestamp_format(sample):
+    timestamp_format = guess_datetime_format(sample)
+    if timestamp_format:
+        return timestamp_format
+    for candidate in FLUKE_TIMESTAMP_FORMATS:
+        try:
+            datetime.strptime(sample, candidate)
+            return candidate
+        except ValueError:
+            continue
+    return None
+
+
+def parse_timestamps(column, timestamp_format):
+    """Arrow string column -> timestamp[us]; Arrow's strptime is much faster but has no %f."""
+    try:
+        return pc.strptime(column, format=timestamp_format, unit="us")
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        parsed = pd.to_datetime(column.to_pandas(), format=timestamp_format)
+        return pa.array(parsed, type=pa.timestamp("us"))
+
+
+def list_recordings(store_dir=FLUKE_STORE_DIR):
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(name for name in os.listdir(store_dir)
+                  if os.path.isfile(os.path.join(store_dir, name, MANIFEST_NAME)))
+
+
+def import_paths(pattern, import_dir=FLUKE_IMPORT_DIR):
+    """CSV files matching a glob relative to import_dir; anything resolving outside it is rejected."""
+    if not import_dir:
+        raise ValueError("Importing server paths is disabled; set FLUKE_IMPORT_DIR to allow it.")
+    root = os.path.realpath(import_dir)
+    paths = sorted(glob.glob(os.path.join(root, pattern)))
+    # realpath also resolves '..' and symlinks that point out of the import directory
+    outside = [path for path in paths if os.path.commonpath([root, os.path.realpath(path)]) != root]
+    if outside or os.path.isabs(pattern):
+        raise ValueError(f"Paths must be relative to the import directory and stay inside it: {pattern}")
+    return [path for path in paths if path.lower().endswith(".csv") and os.path.isfile(path)]
+
+
+def _source_name_and_size(source):
+    if isinstance(source, str):
+        return os.path.basename(source), os.path.getsize(source)
+    # File-like objects such as Streamlit's UploadedFile
+    return source.name, source.size
+
+
+def _prepared_batches(reader, timestamp_format, rollup_parts, row_counts):
+    """Yield date-partitioned float32 batches; each block's 1-minute partial rollup goes to rollup_parts
+    and its row count to row_counts."""
+    for batch in reader:
+        row_counts.append(batch.num_rows)
+        timestamps = parse_timestamps(batch.column("Timestamp"), timestamp_format)
+        columns = {"Timestamp": timestamps}
+        for field in batch.schema:
+            if field.name != "Timestamp":
+                columns[field.name] = batch.column(field.name)
+        columns["date"] = pc.cast(timestamps, pa.date32())
+        table = pa.table(columns)
+
+        channels = table.drop_columns(["date"]).to_pandas().set_index("Timestamp")
+        partial = channels.groupby(channels.index.floor(STORE_ROLLUP_RULE)).agg(["min", "max", "sum", "count"])
+        rollup_parts.append(partial)
+        yield from table.to_batches()
+
+
+def combine_rollups(parts):
+    """Merge partial min/max/sum/count rollups that may share buckets (block and file boundaries)."""
+    combined = pd.concat(parts, axis=0)
+    aggregations = {column: ("min" if column[1] == "min" else "max" if column[1] == "max" else "sum")
+                    for column in combined.columns}
+    combined = combined.groupby(level=0).agg(aggregations)
+    combined.index.name = "Timestamp"
+    return combined
+
+
+def ingest_csvs(sources, recording_dir, progress=None):
+    """Convert CSV paths or file objects into the recording at recording_dir, block by block.
+
+    progress(i, n, name) is called before each file. Returns the updated manifest.
+    """
+    manifest_path = os.path.join(recording_dir, MANIFEST_NAME)
+    manifest = {"channels": [], "rows": 0, "start": None, "end": None, "sources": [],
+                "rollup_rule": STORE_ROLLUP_RULE}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    already_imported = {(s["name"], s["size"]) for s in manifest["sources"]}
+
+    previous_rollup = manifest.get("rollup")
+    rollup_parts = [_unflatten_rollup(pd.read_parquet(os.path.join(recording_dir, previous_rollup)))] if previous_rollup else []
+    data_dir = os.path.join(recording_dir, "data")
+    run_id = uuid.uuid4().hex[:8]
+    try:
+        imported = _ingest_sources(sources, data_dir, run_id, manifest, already_imported, rollup_parts, progress)
+        if imported:
+            # Rollup and manifest of this run get new names: until the manifest is replaced,
+            # readers keep seeing the previous state
+            manifest["rollup"] = f"rollup-{run_id}.parquet"
+            _flatten_rollup(combine_rollups(rollup_parts)).to_parquet(os.path.join(recording_dir, manifest["rollup"]))
+            with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2, ensure_ascii=False)
+            os.replace(manifest_path + ".tmp", manifest_path)
+    except BaseException:
+        # Also on KeyboardInterrupt or a Streamlit rerun: nothing of an unfinished import stays behind
+        for path in glob.glob(os.path.join(data_dir, "*", f"{run_id}-*.parquet")):
+            os.remove(path)
+        for path in (os.path.join(recording_dir, f"rollup-{run_id}.parquet"), manifest_path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    if imported and previous_rollup and previous_rollup != manifest["rollup"]:
+        os.remove(os.path.join(recording_dir, previous_rollup))
+    return manifest
+
+
+def _ingest_sources(sources, data_dir, run_id, manifest, already_imported, rollup_parts, progress):
+    """Write each new source as run-tagged Parquet files and record it in manifest; returns how many."""
+    imported = 0
+    for i, source in enumerate(sources):
+        name, size = _source_name_and_size(source)
+        if progress is not None:
+            progress(i, len(sources), name)
+        if (name, size) in already_imported:
+            continue
+
+        # Header and first data row: the timestamp layout and the column names for the whole file
+        head = pd.read_csv(source, nrows=1, dtype=str)
+        if not isinstance(source, str):
+            source.seek(0)
+        if "Timestamp" not in head.columns:
+            raise ValueError(f"No Timestamp column in {name}")
+        sample = head["Timestamp"].iloc[0]
+        timestamp_format = detect_timestamp_format(sample)
+        if timestamp_format is None:
+            raise ValueError(f"Unrecognized Timestamp layout in {name}: {sample!r}")
+
+        # Explicit types instead of inferring them from the first block: a channel that starts empty or
+        # with a marker keeps the same float type in every block, and a non-numeric cell fails the import
+        column_types = {column: pa.float32() for column in head.columns if column != "Timestamp"}
+        column_types["Timestamp"] = pa.string()
+        reader = pa_csv.open_csv(
+            source,
+            read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types, null_values=FLUKE_NULL_VALUES),
+        )
+        parts_before = len(rollup_parts)
+        row_counts = []
+        written = []
+        batches = _prepared_batches(reader, timestamp_format, rollup_parts, row_counts)
+        first = next(batches, None)
+        if first is None:
+            continue
+        ds.write_dataset(
+            _chain(first, batches), data_dir, schema=first.schema, format="parquet",
+            partitioning=DATE_PARTITIONING, basename_template=f"{run_id}-{i:04d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore", max_rows_per_group=ROWS_PER_GROUP,
+            min_rows_per_group=ROWS_PER_GROUP, file_visitor=lambda written_file: written.append(written_file.path),
+        )
+
+        file_rollup = pd.concat(rollup_parts[parts_before:])
+        file_channels = [c for c in first.schema.names if c not in ("Timestamp", "date")]
+        manifest["channels"] += [c for c in file_channels if c not in manifest["channels"]]
+        rows = sum(row_counts)
+        start, end = file_rollup.index.min(), file_rollup.index.max() + pd.Timedelta(STORE_ROLLUP_RULE)
+        manifest["rows"] += rows
+        manifest["start"] = min(filter(None, [manifest["start"], start.isoformat()]))
+        manifest["end"] = max(filter(None, [manifest["end"], end.isoformat()]))
+        manifest["sources"].append({"name": name, "size": size, "rows": rows, "timestamp_format": timestamp_format,
+                                    "files": sorted(os.path.relpath(path, data_dir) for path in written)})
+        already_imported.add((name, size))
+        imported += 1
+    return imported
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def _flatten_rollup(rollup):
+    flat = rollup.copy()
+    flat.columns = [f"{channel}|{stat}" for channel, stat in rollup.columns]
+    return flat
+
+
+def _unflatten_rollup(flat):
+    rollup = flat.copy()
+    rollup.columns = pd.MultiIndex.from_tuples([tuple(c.rsplit("|", 1)) for c in flat.columns])
+    return rollup
+
+
+class FlukeRecording:
+    """Read side of a recording: memory-mapped Parquet with time-range and column pushdown."""
+
+    def __init__(self, recording_dir):
+        with open(os.path.join(recording_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.path = recording_dir
+        self.channels = self.manifest["channels"]
+        self.rows = self.manifest["rows"]
+        self.start = pd.Timestamp(self.manifest["start"])
+        self.end = pd.Timestamp(self.manifest["end"])
+        # Explicit schema: files that lack a channel (stitched recordings) read it as nulls
+        schema = pa.schema([("Timestamp", pa.timestamp("us"))] + [(c, pa.float32()) for c in self.channels])
+        # Only the files the manifest lists: leftovers of an interrupted import are never read
+        data_dir = os.path.join(recording_dir, "data")
+        files = [os.path.join(data_dir, path) for source in self.manifest["sources"] for path in source["files"]]
+        self.dataset = ds.dataset(files, schema=schema.append(pa.field("date", pa.date32())), format="parquet",
+                                  partitioning=DATE_PARTITIONING, partition_base_dir=data_dir,
+                                  filesystem=pafs.LocalFileSystem(use_mmap=True))
+        self.rollup_path = os.path.join(recording_dir, self.manifest["rollup"])
+
+    def _range_filter(self, start, end):
+        # The date terms prune whole partitions; the Timestamp terms skip row groups by their statistics
+        return ((ds.field("date") >= pa.scalar(start.date(), pa.date32()))
+                & (ds.field("date") <= pa.scalar(end.date(), pa.date32()))
+                & (ds.field("Timestamp") >= pa.scalar(start.to_pydatetime(), pa.timestamp("us")))
+                & (ds.field("Timestamp") <= pa.scalar(end.to_pydatetime(), pa.timestamp("us"))))
+
+    def read_channels(self, channels, start, end):
+        """Samples of the given channels in [start, end] as a frame indexed by Timestamp."""
+        table = self.dataset.to_table(columns=["Timestamp"] + list(channels), filter=self._range_filter(start, end))
+        return table.to_pandas().set_index("Timestamp").sort_index()
+
+    def read_channel(self, channel, start, end):
+        """Samples of one channel in [start, end] as a Series indexed by Timestamp."""
+        return self.read_channels([channel], start, end)[channel].dropna()
+
+    def read_rollup(self, channel, start, end):
+        """1-minute buckets of one channel in [start, end]: columns min, mean, max and count."""
+        columns = [f"{channel}|{stat}" for stat in ("min", "max", "sum", "count")]
+        flat = pd.read_parquet(self.rollup_path, columns=columns,
+                               filters=[("Timestamp", ">=", start), ("Timestamp", "<=", end)])
+        flat.columns = ["min", "max", "sum", "count"]
+        flat = flat[flat["count"] > 0]
+        return pd.DataFrame({"min": flat["min"], "mean": flat["sum"] / flat["count"], "max": flat["max"],
+                             "count": flat["count"]}, index=flat.index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import Fluke CSV exports into the out-of-core recording store.")
+    parser.add_argument("files", nargs="+", help="CSV files or glob patterns; imported in name order")
+    parser.add_argument("--name", required=True, help="Recording name (letters, digits, _ and -)")
+    parser.add_argument("--store", default=FLUKE_STORE_DIR, help="Store directory")
+    args = parser.parse_args(argv)
+
+    if not RECORDING_NAME_PATTERN.match(args.name):
+        raise SystemExit(f"Invalid recording name: {args.name!r}")
+    paths = sorted({path for pattern in args.files for path in (glob.glob(pattern) or [pattern])})
+    manifest = ingest_csvs(paths, os.path.join(args.store, args.name),
+                           progress=lambda i, n, name: print(f"[{i + 1}/{n}] {name}", file=sys.stderr))
+    print(f"{args.name}: {manifest['rows']:,} rows, {len(manifest['channels'])} channels, "
+          f"{manifest['start']} to {manifest['end']}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
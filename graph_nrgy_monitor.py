@@ -1,55 +1,237 @@
+import hashlib
+import os
+
+import numpy as np
 import streamlit as st
 import pandas as pd
 import altair as alt
 
-st.sidebar.image("assets/logo.png")
+from fluke_analysis import (MAX_CHART_POINTS, MAX_GAP_INTERVALS, build_rollup_pyramid, downsample_series,
+                            power_quality_stats, read_fluke_csv, select_rollup_level, thin_rollup, time_range_slice)
+from fluke_store import (FLUKE_IMPORT_DIR, FLUKE_STORE_DIR, MANIFEST_NAME, RECORDING_NAME_PATTERN, STORE_ROLLUP_RULE,
+                         FlukeRecording, import_paths, ingest_csvs, list_recordings)
+
+# Trailing windows offered for the rolling mean; 15min is the usual demand interval
+ROLLING_WINDOWS = ["1min", "10min", "15min", "1h"]
+
+
+# cache_resource hands back the same frame on every rerun instead of a pickled copy;
+# the frame is never mutated below. Keyed by the SHA-256 of the file contents.
+@st.cache_resource(max_entries=4, show_spinner="Loading file...")
+def load_fluke_csv(file_hash, _file_bytes):
+    return read_fluke_csv(_file_bytes)
+
+
+@st.cache_resource(max_entries=4, show_spinner="Building rollups...")
+def cached_rollup_pyramid(file_hash, _df):
+    # Built once per file; every range and channel is then drawn from it
+    return build_rollup_pyramid(_df)
+
+
+@st.cache_data(max_entries=32, show_spinner="Computing statistics...")
+def cached_power_quality_stats(source_id, channels, start, end, window, thresholds, _load_frame):
+    # Keyed by the data source and the selection; the frame is only loaded on a miss
+    return power_quality_stats(_load_frame(list(channels), start, end), window, dict(thresholds))
 
-st.title("Datos del analizador")
 
-uploaded_file = st.file_uploader("Agrega tu archivo .csv", type="csv")
+def power_quality_panel(source_id, channels, start, end, load_frame):
+    """Statistics for the selected range and channels; load_frame(channels, start, end) returns the samples."""
+    if not st.toggle("Power quality statistics"):
+        return
+    selected_channels = st.multiselect("Channels", channels, default=channels[:1])
+    window = st.selectbox("Rolling mean window", ROLLING_WINDOWS, index=ROLLING_WINDOWS.index("15min"))
+    limits = st.data_editor(
+        pd.DataFrame({'Lower limit': np.nan, 'Upper limit': np.nan}, index=pd.Index(selected_channels)),
+        key=f"thresholds_{'|'.join(selected_channels)}",
+    )
+    if not selected_channels:
+        return
+    thresholds = tuple(
+        (channel, tuple(None if pd.isna(v) else float(v) for v in limits.loc[channel]))
+        for channel in selected_channels
+    )
+    stats = cached_power_quality_stats(source_id, tuple(selected_channels), start, end, window, thresholds,
+                                       load_frame)
+    st.dataframe(stats, use_container_width=True)
+    st.caption("Integral: trapezoidal sum in channel units times hours (Wh for power in W); "
+               f"gaps longer than {MAX_GAP_INTERVALS} sampling intervals are not integrated.")
 
-if uploaded_file is not None:
-    df = pd.read_csv(uploaded_file)
 
-    # Convert 'Timestamp' to datetime objects
-    df['Timestamp'] = pd.to_datetime(df['Timestamp'])
-    df = df.set_index('Timestamp')
+@st.cache_resource(max_entries=8)
+def open_recording(recording_dir, manifest_mtime):
+    # Keyed by the manifest's mtime so an import into the same recording reopens it
+    return FlukeRecording(recording_dir)
 
+
+def select_time_range(min_timestamp, max_timestamp):
     st.sidebar.header("Opciones de visualización")
 
     # Date Range Selection
-    min_date = df.index.min()
-    max_date = df.index.max()
-    start_date = st.sidebar.date_input("Start Date", min_date)
-    end_date = st.sidebar.date_input("End Date", max_date)
+    start_date = st.sidebar.date_input("Start Date", min_timestamp)
+    end_date = st.sidebar.date_input("End Date", max_timestamp)
 
     # Time Range Selection (optional, for more granular control)
-    start_time = st.sidebar.time_input("Start Time", df.index.min().time())
-    end_time = st.sidebar.time_input("End Time", df.index.max().time())
+    start_time = st.sidebar.time_input("Start Time", min_timestamp.time())
+    end_time = st.sidebar.time_input("End Time", max_timestamp.time())
+
+    return pd.to_datetime(f"{start_date} {start_time}"), pd.to_datetime(f"{end_date} {end_time}")
+
+
+def draw_rollup_chart(parameter, rollup_level, rollup_df, sample_count):
+    base = alt.Chart(rollup_df.reset_index()).encode(x=alt.X('Timestamp', title='Time'))
+    band = base.mark_area(opacity=0.3).encode(
+        y=alt.Y('min', title=parameter),
+        y2='max'
+    )
+    line = base.mark_line().encode(
+        y='mean',
+        tooltip=['Timestamp', 'min', 'mean', 'max']
+    )
+    st.altair_chart((band + line).interactive(), use_container_width=True)
+    st.caption(f"Showing {len(rollup_df):,} points from the {rollup_level} rollup (min/mean/max) "
+               f"for {sample_count:,} samples.")
+
 
-    start_datetime = pd.to_datetime(f"{start_date} {start_time}")
-    end_datetime = pd.to_datetime(f"{end_date} {end_time}")
+def draw_sample_chart(parameter, range_series):
+    # Reduce to a pixel-appropriate number of points; recomputed whenever the range changes
+    chart_series = downsample_series(range_series)
+    chart_data = chart_series.reset_index()
+    chart = alt.Chart(chart_data).mark_line().encode(
+        x=alt.X('Timestamp', title='Time'),
+        y=alt.Y(parameter, title=parameter),
+        tooltip=['Timestamp', parameter]
+    ).interactive()
+    st.altair_chart(chart, use_container_width=True)
+    if len(chart_series) < len(range_series):
+        st.caption(f"Showing {len(chart_series):,} of {len(range_series):,} samples (LTTB downsampling).")
 
-    filtered_df = df[(df.index >= start_datetime) & (df.index <= end_datetime)]
 
-    # Parameter Selection
-    parameter_options = filtered_df.columns.tolist()
-    selected_parameter = st.sidebar.selectbox("Select Parameter to Plot", parameter_options)
+def import_recording_form():
+    """Stream CSV exports into the out-of-core store; large recordings are best given as server paths.
 
-    st.subheader(f"Dynamic Plot of {selected_parameter}")
+    Server paths are only offered when FLUKE_IMPORT_DIR is set, and only files inside it are read.
+    """
+    with st.expander("Import files into the store"):
+        uploaded_files = st.file_uploader("Analyzer .csv files", type="csv", accept_multiple_files=True,
+                                          key="import_files")
+        server_pattern = ""
+        if FLUKE_IMPORT_DIR:
+            server_pattern = st.text_input(f"Or paths under {FLUKE_IMPORT_DIR} (wildcards allowed, e.g. site_a/*.csv)")
+        recording_name = st.text_input("Recording name (letters, digits, _ and -)")
+        if not st.button("Import"):
+            return
 
-    if selected_parameter:
+        if not RECORDING_NAME_PATTERN.match(recording_name):
+            st.error("Please enter a valid recording name.")
+            return
+        # Several logger files are stitched in name order into one time-partitioned recording
+        sources = sorted(uploaded_files, key=lambda f: f.name)
+        if server_pattern:
+            try:
+                sources += import_paths(server_pattern)
+            except ValueError as e:
+                st.error(str(e))
+                return
+        if not sources:
+            st.error("Please add files or enter server paths.")
+            return
+
+        progress = st.progress(0.0)
         try:
-            chart_data = filtered_df[[selected_parameter]].reset_index()
-            chart = alt.Chart(chart_data).mark_line().encode(
-                x=alt.X('Timestamp', title='Time'),
-                y=alt.Y(selected_parameter, title=selected_parameter),
-                tooltip=['Timestamp', selected_parameter]
-            ).interactive()
-            st.altair_chart(chart, use_container_width=True)
-        except KeyError:
-            st.error("Selected parameter not found in the data.")
-        except Exception as e:
-            st.error(f"An error occurred while plotting: {e}")
+            manifest = ingest_csvs(sources, os.path.join(FLUKE_STORE_DIR, recording_name),
+                                   progress=lambda i, n, name: progress.progress(i / n, text=f"Importing {name}"))
+        except (ValueError, KeyError, OSError) as e:
+            st.error(f"Import failed: {e}")
+            return
+        progress.empty()
+        st.success(f"{recording_name}: {manifest['rows']:,} samples from {manifest['start']} to {manifest['end']}.")
+
+
+st.sidebar.image("assets/logo.png")
+
+st.title("Datos del analizador")
+
+data_source = st.radio("Data source", ["CSV file", "Stored recording"], horizontal=True)
+
+if data_source == "CSV file":
+    uploaded_file = st.file_uploader("Agrega tu archivo .csv", type="csv")
+
+    if uploaded_file is not None:
+        file_bytes = uploaded_file.getvalue()
+        file_hash = hashlib.sha256(file_bytes).hexdigest()
+        df = load_fluke_csv(file_hash, file_bytes)
+        rollup_pyramid = cached_rollup_pyramid(file_hash, df)
+
+        start_datetime, end_datetime = select_time_range(df.index.min(), df.index.max())
+
+        # The index is sorted at load time, so the range is two binary searches
+        selected_range = time_range_slice(df.index, start_datetime, end_datetime)
+
+        # Parameter Selection
+        parameter_options = df.columns.tolist()
+        selected_parameter = st.sidebar.selectbox("Select Parameter to Plot", parameter_options)
+
+        st.subheader(f"Dynamic Plot of {selected_parameter}")
+
+        if selected_parameter:
+            try:
+                # Only the selected column is pulled, as a positional view of the range
+                range_series = df[selected_parameter].iloc[selected_range]
+
+                # Wide ranges are drawn from the coarsest rollup that still fills the chart
+                rollup = None
+                if len(range_series) > MAX_CHART_POINTS:
+                    rollup = select_rollup_level(rollup_pyramid, selected_parameter, start_datetime, end_datetime)
+
+                if rollup is not None:
+                    draw_rollup_chart(selected_parameter, *rollup, len(range_series))
+                else:
+                    draw_sample_chart(selected_parameter, range_series)
+            except KeyError:
+                st.error("Selected parameter not found in the data.")
+            except Exception as e:
+                st.error(f"An error occurred while plotting: {e}")
+        else:
+            st.info("Please select a parameter to plot.")
+
+        power_quality_panel(file_hash, df.select_dtypes('number').columns.tolist(), start_datetime, end_datetime,
+                            lambda channels, start, end: df[channels].iloc[time_range_slice(df.index, start, end)])
+
+else:
+    import_recording_form()
+
+    recordings = list_recordings(FLUKE_STORE_DIR)
+    if not recordings:
+        st.info("No recordings yet. Import files above or with `python fluke_store.py --name <name> <files>`.")
     else:
-        st.info("Please select a parameter to plot.")
\ No newline at end of file
+        recording_name = st.selectbox("Recording", recordings)
+        recording_dir = os.path.join(FLUKE_STORE_DIR, recording_name)
+        manifest_mtime = os.path.getmtime(os.path.join(recording_dir, MANIFEST_NAME))
+        recording = open_recording(recording_dir, manifest_mtime)
+        st.caption(f"{recording.rows:,} samples in {len(recording.manifest['sources'])} file(s), "
+                   f"{len(recording.channels)} channels.")
+
+        start_datetime, end_datetime = select_time_range(recording.start, recording.end)
+        selected_parameter = st.sidebar.selectbox("Select Parameter to Plot", recording.channels)
+
+        st.subheader(f"Dynamic Plot of {selected_parameter}")
+
+        if selected_parameter:
+            try:
+                # Nothing is held in memory: the stored rollup decides whether the raw samples are needed,
+                # and only then is the selected column read for the range, memory-mapped from Parquet
+                rollup_df = recording.read_rollup(selected_parameter, start_datetime, end_datetime)
+                sample_count = int(rollup_df['count'].sum())
+                if len(rollup_df) >= MAX_CHART_POINTS:
+                    draw_rollup_chart(selected_parameter, STORE_ROLLUP_RULE,
+                                      thin_rollup(rollup_df[['min', 'mean', 'max']]), sample_count)
+                else:
+                    range_series = recording.read_channel(selected_parameter, start_datetime, end_datetime)
+                    draw_sample_chart(selected_parameter, range_series)
+            except Exception as e:
+                st.error(f"An error occurred while plotting: {e}")
+        else:
+            st.info("Please select a parameter to plot.")
+
+        power_quality_panel((recording_dir, manifest_mtime), recording.channels, start_datetime,
+                            end_datetime, recording.read_channels)